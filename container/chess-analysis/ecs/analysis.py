@@ -221,23 +221,23 @@ def analyze_moves(moves, engine, board):
         MULTIPLIER = -0.00368208
         return 1 / (1 + math.exp(MULTIPLIER * cp))
 
+    # Each distinct position is analyzed once; the score after a move is
+    # reused as the score before the next one
+    score_before = engine.analyse(board, chess.engine.Limit(depth=20))['score']
+
     for i, move_san in enumerate(moves):
         player = 'white' if i % 2 == 0 else 'black'
         try:
-            # Analyze before the move
-            info_before = engine.analyse(board, chess.engine.Limit(depth=20))
-            score_before = info_before['score']
-            cp_before = score_before.white().score(mate_score=10000) if player == 'white' else score_before.black().score(mate_score=10000)
-
             # Parse and apply the move
             move = board.parse_san(move_san)
             board.push(move)
             log_print(move_san)
 
             # Analyze after the move
-            info_after = engine.analyse(board, chess.engine.Limit(depth=20))
-            score_after = info_after['score']
+            score_after = engine.analyse(board, chess.engine.Limit(depth=20))['score']
+            cp_before = score_before.white().score(mate_score=10000) if player == 'white' else score_before.black().score(mate_score=10000)
             cp_after = int(score_after.white().score(mate_score=10000)) if player == 'white' else int(score_after.black().score(mate_score=10000))
+            score_before = score_after
 
             wp_before = winning_chances(cp_before)
             wp_after = winning_chances(cp_after)
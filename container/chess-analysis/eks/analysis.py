@@ -1,23 +1,319 @@
 import json
+import hashlib
+import asyncio
+import threading
+import sqlite3
+from collections import Counter, OrderedDict
 import chess
 import chess.engine
+import chess.polyglot
+import chess.syzygy
 import math
 import boto3
+from botocore.exceptions import ClientError
 import os
 from datetime import timezone, datetime
 import signal
 import sys
+import time
+import uuid
+import random
+import atexit
+import cProfile
+import pstats
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 AWS_REGION = os.getenv('AWS_REGION')
 QUEUE_URL = os.getenv('SQS_QUEUE_URL')
 PLAYER_STATS_TABLE = os.getenv('PLAYER_STATS_TABLE')
 PROCESSED_GAMES_TABLE = os.getenv('PROCESSED_GAMES_TABLE')
+ENGINE_PATH = os.getenv('ENGINE_PATH')
+ENGINE_BUILDS_DIR = os.getenv('ENGINE_BUILDS_DIR', '/usr/local/bin/stockfish-builds')
+ENGINE_BENCH_TIME = float(os.getenv('ENGINE_BENCH_TIME', '1.0'))
+ENGINE_POOL_SIZE = int(os.getenv('ENGINE_POOL_SIZE', '1'))
+ENGINE_THREADS = os.getenv('ENGINE_THREADS')
+ENGINE_HASH = os.getenv('ENGINE_HASH')
+ANALYSIS_PARALLELISM = os.getenv('ANALYSIS_PARALLELISM', 'game')
+EVAL_CACHE_SIZE = int(os.getenv('EVAL_CACHE_SIZE', '100000'))
+EVAL_CACHE_PATH = os.getenv('EVAL_CACHE_PATH')
+EVAL_CACHE_DISK_ROWS = int(os.getenv('EVAL_CACHE_DISK_ROWS', '2000000'))
+
+SEARCH_DEPTH = os.getenv('SEARCH_DEPTH')
+SEARCH_NODES = os.getenv('SEARCH_NODES')
+SEARCH_MOVETIME = os.getenv('SEARCH_MOVETIME')  # milliseconds
+DECISIVE_DEPTH = os.getenv('DECISIVE_DEPTH')
+DECISIVE_CP = int(os.getenv('DECISIVE_CP', '1500'))
+REFINE_DEPTH = os.getenv('REFINE_DEPTH')
+REFINE_MARGIN = float(os.getenv('REFINE_MARGIN', '0.03'))
+SYZYGY_PATH = os.getenv('SYZYGY_PATH')
+BOOK_PATH = os.getenv('BOOK_PATH')
+STATS_FLUSH_GAMES = int(os.getenv('STATS_FLUSH_GAMES', '0'))
+CHECKPOINT_PLIES = int(os.getenv('CHECKPOINT_PLIES', '0'))
+ROSTER_TTL = float(os.getenv('ROSTER_TTL', '3600'))
+METRICS_PORT = int(os.getenv('METRICS_PORT') or '0')
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'info').lower()
+LOG_SAMPLE_RATE = float(os.getenv('LOG_SAMPLE_RATE', '0.01'))
+LOG_BUFFER_LINES = int(os.getenv('LOG_BUFFER_LINES', '200'))
+LOG_FLUSH_SECONDS = float(os.getenv('LOG_FLUSH_SECONDS', '1.0'))
+LOG_LEVELS = {'debug': 10, 'info': 20, 'warning': 30, 'error': 40}
+PROFILE_DIR = os.getenv('PROFILE_DIR')
+PROFILE_TOP = int(os.getenv('PROFILE_TOP', '30'))
+PROFILE_INTERVAL = float(os.getenv('PROFILE_INTERVAL', '0.005'))
+# TransactWriteItems takes at most 100 items, one of them the ProcessedGames marker
+TRANSACTION_PLAYERS = 99
+STATS_SINK = os.getenv('STATS_SINK', 'dynamodb')
+RESULTS_QUEUE_URL = os.getenv('RESULTS_QUEUE_URL')
+RESULTS_DIR = os.getenv('RESULTS_DIR')
+REDUCER_MAX_RECEIVES = int(os.getenv('REDUCER_MAX_RECEIVES', '1000'))
+DRAIN_MODE = os.getenv('DRAIN_MODE', 'false').lower() == 'true'
+MAX_MESSAGES = int(os.getenv('MAX_MESSAGES', '0'))
+MAX_RUNTIME = float(os.getenv('MAX_RUNTIME', '0'))
+RECEIVE_BATCH_SIZE = 10
+RECEIVE_WAIT_SECONDS = int(os.getenv('RECEIVE_WAIT_SECONDS', '20'))
+VISIBILITY_TIMEOUT = int(os.getenv('VISIBILITY_TIMEOUT', '300'))
+HEARTBEAT_INTERVAL = float(os.getenv('HEARTBEAT_INTERVAL', str(VISIBILITY_TIMEOUT / 3)))
+PREFETCH_MESSAGES = int(os.getenv('PREFETCH_MESSAGES', '0'))
+
+DEFAULT_ENGINE_PATH = '/usr/local/bin/stockfish'
+# Stockfish build suffixes from fastest to most portable, with the CPU
+# feature flags each one needs
+ENGINE_BUILDS = [
+    ('x86-64-vnni512', {'avx512vnni', 'avx512bw', 'avx512f'}),
+    ('x86-64-avx512', {'avx512bw', 'avx512f'}),
+    ('x86-64-bmi2', {'bmi2', 'avx2'}),
+    ('x86-64-avx2', {'avx2'}),
+    ('x86-64-sse41-popcnt', {'sse4_1', 'popcnt'}),
+    ('x86-64', set()),
+    ('armv8-dotprod', {'asimddp'}),
+    ('armv8', set()),
+]
+BENCH_FEN = 'r1bq1rk1/pp2bppp/2n1pn2/3p4/2PP4/2N2N2/PP2BPPP/R2QKB1R w KQ - 0 9'
+
+MATE_SCORE = 10000
+TABLEBASE_WIN_SCORE = 5000
+
+def search_limit(depth=SEARCH_DEPTH, nodes=SEARCH_NODES, movetime=SEARCH_MOVETIME):
+    if not (depth or nodes or movetime):
+        return chess.engine.Limit(depth=20)
+    return chess.engine.Limit(
+        depth=int(depth) if depth else None,
+        nodes=int(nodes) if nodes else None,
+        time=int(movetime) / 1000 if movetime else None
+    )
+
+SEARCH_LIMIT = search_limit()
+DECISIVE_LIMIT = chess.engine.Limit(depth=int(DECISIVE_DEPTH)) if DECISIVE_DEPTH else None
+REFINE_LIMIT = chess.engine.Limit(depth=int(REFINE_DEPTH)) if REFINE_DEPTH else None
+
+CLASSIFICATION_THRESHOLDS = (('blunders', 0.2), ('mistakes', 0.1), ('inaccuracies', 0.05))
 
 shutdown_flag = False
+shutdown_signal = None
+shutdown_releases = (0, [])
 message = None
+tablebase = None
+tablebase_hits = 0
+opening_book = None
+result_sink = None
+prefetcher = None
+heartbeat = None
+eval_cache = None
+tracked_roster = None
+analysis_progress = 0
+
+class EventLog:
+    """Writes leveled JSON log events to stdout in buffered batches.
+
+    Events below the configured level are dropped before they are built,
+    and sampled events, such as one per engine search, are only kept at
+    sample_rate. The buffer is written out when it fills, every
+    flush_seconds, on warnings and errors, and at exit.
+    """
+
+    def __init__(self, level=LOG_LEVEL, sample_rate=LOG_SAMPLE_RATE,
+                 buffer_lines=LOG_BUFFER_LINES, flush_seconds=LOG_FLUSH_SECONDS):
+        self.level = LOG_LEVELS.get(level, LOG_LEVELS['info'])
+        self.sample_rate = sample_rate
+        self.buffer_lines = buffer_lines
+        self.flush_seconds = flush_seconds
+        # Reentrant, as the signal handler can interrupt the main thread while it holds the lock
+        self.lock = threading.RLock()
+        self.buffer = []
+        self.flusher = None
+
+    def enabled(self, level, sampled=False):
+        if LOG_LEVELS[level] < self.level:
+            return False
+        return not sampled or random.random() < self.sample_rate
+
+    def emit(self, level, event, sampled=False, **fields):
+        if not self.enabled(level, sampled):
+            return
+        line = json.dumps({'ts': round(time.time(), 3), 'level': level, 'event': event, **fields}, default=str)
+        with self.lock:
+            self.buffer.append(line)
+            if self.flusher is None:
+                self.flusher = threading.Thread(target=self._flush_periodically, daemon=True)
+                self.flusher.start()
+            if len(self.buffer) < self.buffer_lines and LOG_LEVELS[level] < LOG_LEVELS['warning']:
+                return
+        self.flush()
+
+    def flush(self):
+        with self.lock:
+            lines, self.buffer = self.buffer, []
+        if lines:
+            sys.stdout.write("\n".join(lines) + "\n")
+            sys.stdout.flush()
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(self.flush_seconds)
+            self.flush()
+
+event_log = EventLog()
+atexit.register(event_log.flush)
+
+def log_event(event, level='info', sampled=False, **fields):
+    event_log.emit(level, event, sampled, **fields)
+
+def log_print(*args, level='info'):
+    if event_log.enabled(level):
+        event_log.emit(level, 'log', msg=" ".join(str(arg) for arg in args))
+
+class Metrics:
+    """Counters, gauges and histograms rendered in the Prometheus text format.
+
+    A metric can be given a collect function, which is called for its
+    value at render time instead of being updated as work happens.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
 
-def log_print(*args, **kwargs):
-    print(*args, **kwargs, flush=True)
+    def counter(self, name, help, collect=None):
+        self.metrics[name] = {'type': 'counter', 'help': help, 'value': 0, 'collect': collect}
+
+    def gauge(self, name, help, collect=None):
+        self.metrics[name] = {'type': 'gauge', 'help': help, 'value': 0, 'collect': collect}
+
+    def histogram(self, name, help, buckets):
+        self.metrics[name] = {'type': 'histogram', 'help': help, 'buckets': buckets,
+                              'counts': [0] * len(buckets), 'sum': 0, 'count': 0}
+
+    def inc(self, name, value=1):
+        with self.lock:
+            self.metrics[name]['value'] += value
+
+    def set(self, name, value):
+        with self.lock:
+            self.metrics[name]['value'] = value
+
+    def observe(self, name, value):
+        with self.lock:
+            metric = self.metrics[name]
+            for i, bound in enumerate(metric['buckets']):
+                if value <= bound:
+                    metric['counts'][i] += 1
+                    break
+            metric['sum'] += value
+            metric['count'] += 1
+
+    def value(self, name):
+        metric = self.metrics[name]
+        if metric.get('collect') is not None:
+            return metric['collect']()
+        return metric['count'] if metric['type'] == 'histogram' else metric['value']
+
+    def render(self):
+        lines = []
+        for name, metric in self.metrics.items():
+            lines.append(f"# HELP {name} {metric['help']}")
+            lines.append(f"# TYPE {name} {metric['type']}")
+            if metric['type'] != 'histogram':
+                try:
+                    lines.append(f"{name} {self.value(name)}")
+                except Exception as e:
+                    log_print("Error collecting metric", name, ":", str(e), level='error')
+                continue
+            with self.lock:
+                cumulative = 0
+                for bound, count in zip(metric['buckets'], metric['counts']):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{le="{bound}"}} {cumulative}')
+                lines.append(f'{name}_bucket{{le="+Inf"}} {metric["count"]}')
+                lines.append(f"{name}_sum {metric['sum']}")
+                lines.append(f"{name}_count {metric['count']}")
+        return "\n".join(lines) + "\n"
+
+def estimated_message_seconds_left():
+    done = metrics.value('analysis_message_games_done')
+    if not done:
+        return 0
+    elapsed = time.time() - metrics.value('analysis_message_start_time_seconds')
+    return elapsed / done * (metrics.value('analysis_message_games') - done)
+
+metrics = Metrics()
+metrics.counter('analysis_messages_total', 'Messages processed')
+metrics.counter('analysis_games_total', 'Games analyzed')
+metrics.counter('analysis_plies_total', 'Plies classified, book plies included')
+metrics.counter('analysis_engine_searches_total', 'Engine searches run')
+metrics.counter('analysis_engine_nodes_total', 'Nodes searched by the engine')
+metrics.histogram('analysis_engine_search_seconds', 'Wall time of an engine search',
+                  (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10))
+metrics.histogram('analysis_game_seconds', 'Wall time to analyze a game',
+                  (1, 5, 10, 30, 60, 120, 300, 600))
+metrics.histogram('analysis_dynamodb_write_seconds', 'Latency of DynamoDB writes',
+                  (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5))
+metrics.counter('analysis_eval_cache_hits_total', 'Evaluation cache hits, memory and disk',
+                lambda: eval_cache.stats()['hits'] + eval_cache.stats()['disk_hits'] if eval_cache else 0)
+metrics.counter('analysis_eval_cache_misses_total', 'Evaluation cache misses',
+                lambda: eval_cache.stats()['misses'] if eval_cache else 0)
+metrics.counter('analysis_tablebase_hits_total', 'Positions scored from the tablebases',
+                lambda: tablebase_hits)
+metrics.counter('analysis_lease_extensions_total', 'Message lease extensions by the heartbeat',
+                lambda: heartbeat.extensions if heartbeat else 0)
+metrics.gauge('analysis_message_games', 'Games in the current message')
+metrics.gauge('analysis_message_games_done', 'Games of the current message analyzed so far')
+metrics.gauge('analysis_message_start_time_seconds', 'Unix time the current message was started')
+metrics.gauge('analysis_message_seconds_left', 'Estimated seconds left on the current message',
+              estimated_message_seconds_left)
+
+def record_write_latency(client):
+    """Times every DynamoDB write made through the client into the write latency histogram."""
+    def started(context, **kwargs):
+        context['write_started'] = time.perf_counter()
+
+    def finished(context, **kwargs):
+        if 'write_started' in context:
+            metrics.observe('analysis_dynamodb_write_seconds', time.perf_counter() - context['write_started'])
+
+    for operation in ('PutItem', 'UpdateItem', 'TransactWriteItems'):
+        client.meta.events.register(f'before-call.dynamodb.{operation}', started)
+        client.meta.events.register(f'after-call.dynamodb.{operation}', finished)
+
+def start_metrics_server(port=METRICS_PORT):
+    """Serves the metrics at /metrics on a background thread."""
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('', port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    log_print("Serving metrics on port", server.server_address[1])
+    return server
 
 def init_resources():
     global sqs, player_stats_table, processed_games_table
@@ -25,341 +321,1693 @@ def init_resources():
     try:
         log_print("Initializing SQS client in region:", AWS_REGION)
         sqs = boto3.client('sqs', region_name=AWS_REGION)
-        log_print("SQS client created:", sqs)
+        log_print("SQS client created.", level='debug')
     except Exception as e:
-        log_print("Error initializing SQS client:", str(e))
+        log_print("Error initializing SQS client:", str(e), level='error')
 
     try:
         log_print("Initializing DynamoDB resource in region:", AWS_REGION)
         dynamodb = boto3.resource('dynamodb', region_name=AWS_REGION)
+        record_write_latency(dynamodb.meta.client)
         player_stats_table = dynamodb.Table(PLAYER_STATS_TABLE)
         processed_games_table = dynamodb.Table(PROCESSED_GAMES_TABLE)
         log_print("DynamoDB tables initialized: PLAYER_STATS_TABLE =", PLAYER_STATS_TABLE,
                   "PROCESSED_GAMES_TABLE =", PROCESSED_GAMES_TABLE)
     except Exception as e:
-        log_print("Error initializing DynamoDB resource:", str(e))
+        log_print("Error initializing DynamoDB resource:", str(e), level='error')
+
+def engine_options():
+    options = {}
+    if ENGINE_THREADS:
+        options['Threads'] = int(ENGINE_THREADS)
+    if ENGINE_HASH:
+        options['Hash'] = int(ENGINE_HASH)
+    return options
+
+def limit_key(limit):
+    return ",".join(f"{name}={value}" for name, value in sorted(vars(limit).items()) if value is not None)
+
+class EvalCache:
+    """White-relative centipawn scores keyed by engine, Zobrist hash and
+    search limit.
+
+    Scores are held in an in-process LRU. When a path is given they are also
+    written through to a SQLite file, so a cache on a node's hostPath is
+    shared by every Job that runs there. The engine is set once it has
+    started, so scores from another Stockfish version, build or options are
+    never reused. The file keeps at most disk_rows scores; the ones written
+    longest ago are deleted first.
+    """
+
+    trim_every = 1000
+
+    def __init__(self, size=EVAL_CACHE_SIZE, path=None, disk_rows=EVAL_CACHE_DISK_ROWS):
+        self.size = size
+        self.disk_rows = disk_rows
+        self.engine = ''
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.db = None
+        if path:
+            self.db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS scores ("
+                            "engine TEXT NOT NULL, zobrist INTEGER NOT NULL, search_limit TEXT NOT NULL, "
+                            "score INTEGER NOT NULL, PRIMARY KEY (engine, zobrist, search_limit))")
+
+    def set_engine(self, identity):
+        """Keys the scores by the engine they come from; scores held for another engine are dropped."""
+        with self.lock:
+            self.engine = hashlib.sha1(identity.encode()).hexdigest()[:16]
+            self.entries.clear()
+
+    def _key(self, board, limit):
+        zobrist = chess.polyglot.zobrist_hash(board)
+        # SQLite integers are signed 64-bit
+        if zobrist >= 1 << 63:
+            zobrist -= 1 << 64
+        return self.engine, zobrist, limit_key(limit)
+
+    def get(self, board, limit):
+        key = self._key(board, limit)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            if self.db is not None:
+                row = self.db.execute("SELECT score FROM scores WHERE engine = ? AND zobrist = ? AND search_limit = ?",
+                                      key).fetchone()
+                if row is not None:
+                    self.disk_hits += 1
+                    self._remember(key, row[0])
+                    return row[0]
+            self.misses += 1
+            return None
+
+    def put(self, board, limit, score):
+        key = self._key(board, limit)
+        with self.lock:
+            self._remember(key, score)
+            if self.db is not None:
+                self.db.execute("INSERT OR REPLACE INTO scores (engine, zobrist, search_limit, score) "
+                                "VALUES (?, ?, ?, ?)", (*key, score))
+                self.writes += 1
+                if self.disk_rows and self.writes % self.trim_every == 0:
+                    self._trim()
+
+    def _trim(self):
+        # New and replaced rows take the next rowid, so the lowest ones were written longest ago
+        self.db.execute("DELETE FROM scores WHERE rowid <= (SELECT MAX(rowid) FROM scores) - ?", (self.disk_rows,))
+
+    def _remember(self, key, score):
+        self.entries[key] = score
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses}
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+def init_eval_cache(size=EVAL_CACHE_SIZE, path=EVAL_CACHE_PATH):
+    global eval_cache
+    try:
+        log_print("Initializing evaluation cache. Size:", size, "path:", path)
+        eval_cache = EvalCache(size, path)
+    except Exception as e:
+        log_print("Error opening on-disk evaluation cache, using memory only:", str(e), level='error')
+        eval_cache = EvalCache(size)
+
+def init_tablebase(path=SYZYGY_PATH):
+    global tablebase
+    tablebase = None
+    if not path:
+        return
+    try:
+        log_print("Loading Syzygy tablebases from:", path)
+        tb = chess.syzygy.Tablebase()
+        tables = sum(tb.add_directory(directory) for directory in path.split(os.pathsep))
+        if tables:
+            tablebase = tb
+        else:
+            tb.close()
+        log_print("Syzygy tables loaded:", tables)
+    except Exception as e:
+        log_print("Error loading Syzygy tablebases:", str(e), level='error')
+
+def tablebase_score(position):
+    """Returns the white-relative score of a tablebase position, or None.
+
+    Wins and losses map to TABLEBASE_WIN_SCORE less the distance to zeroing,
+    so they sit well beyond the point where winning_chances saturates.
+    Cursed wins and blessed losses are draws under the 50-move rule.
+    """
+    global tablebase_hits
+    if tablebase is None or chess.popcount(position.occupied) > chess.syzygy.TBPIECES:
+        return None
+    try:
+        wdl = tablebase.probe_wdl(position)
+    except (KeyError, chess.syzygy.MissingTableError):
+        return None
+    if wdl in (-1, 0, 1):
+        score = 0
+    else:
+        try:
+            dtz = abs(tablebase.probe_dtz(position))
+        except (KeyError, chess.syzygy.MissingTableError):
+            dtz = 0
+        score = TABLEBASE_WIN_SCORE - dtz if wdl > 0 else dtz - TABLEBASE_WIN_SCORE
+    tablebase_hits += 1
+    return score if position.turn == chess.WHITE else -score
+
+def tablebase_plies(tablebase_scores):
+    """Returns the plies whose positions before and after both have a tablebase score."""
+    return {i for i in range(len(tablebase_scores) - 1)
+            if tablebase_scores[i] is not None and tablebase_scores[i + 1] is not None}
+
+def needs_search(tablebase_scores):
+    """Returns, for every position, whether it needs an engine score.
+
+    Tablebase scores are only compared with each other, never with engine
+    centipawns, so a position in the tablebase is still searched when a ply
+    next to it is scored by the engine, such as the capture that enters it.
+    """
+    exact = tablebase_plies(tablebase_scores)
+    last = len(tablebase_scores) - 1
+    return [score is None or (i > 0 and i - 1 not in exact) or (i < last and i not in exact)
+            for i, score in enumerate(tablebase_scores)]
+
+def init_book(path=BOOK_PATH):
+    global opening_book
+    opening_book = None
+    if not path:
+        return
+    # BOOK_PATH points at the image's book, which is only there when one was bundled
+    if not os.path.exists(path):
+        log_print("No opening book at", path)
+        return
+    try:
+        log_print("Loading opening book from:", path)
+        opening_book = chess.polyglot.open_reader(path)
+    except Exception as e:
+        log_print("Error loading opening book:", str(e), level='error')
+
+def count_book_plies(positions, book):
+    """Returns how many plies from the start of the game were book moves."""
+    if book is None:
+        return 0
+    for i in range(len(positions) - 1):
+        move = positions[i + 1].peek()
+        if not any(entry.move == move for entry in book.find_all(positions[i])):
+            return i
+    return len(positions) - 1
+
+def terminal_score(position):
+    """Returns the exact white-relative score of a finished game, or None."""
+    if position.is_checkmate():
+        return -MATE_SCORE if position.turn == chess.WHITE else MATE_SCORE
+    if position.is_stalemate() or position.is_insufficient_material():
+        return 0
+    return None
+
+def is_decisive(cp, threshold=DECISIVE_CP):
+    # Beyond the threshold winning_chances is saturated (0.9962 at 1500cp),
+    # so no move between two such positions can reach the 0.05 cutoff
+    return abs(cp) >= threshold
+
+def evaluation_steps(position, cache=None):
+    """Yields the search limits needed to score a position and receives the
+    white-relative score of each search; returns the final score.
+
+    Finished games are scored without a search. With DECISIVE_DEPTH set, a shallow search runs first and a position
+    that is already decided keeps its shallow score instead of paying for
+    the full search.
+    """
+    score = terminal_score(position)
+    if score is not None:
+        return score
+
+    score = cache.get(position, SEARCH_LIMIT) if cache is not None else None
+    if score is not None:
+        return score
+
+    if DECISIVE_LIMIT is not None:
+        score = cache.get(position, DECISIVE_LIMIT) if cache is not None else None
+        if score is None:
+            score = yield DECISIVE_LIMIT
+            if cache is not None:
+                cache.put(position, DECISIVE_LIMIT, score)
+        if is_decisive(score):
+            return score
+
+    score = yield SEARCH_LIMIT
+    if cache is not None:
+        cache.put(position, SEARCH_LIMIT, score)
+    return score
 
-def init_engine(path='/usr/local/bin/stockfish'):
+def shallow_steps(position, cache=None):
+    """Evaluation steps of the cheap first pass of two-tier refinement."""
+    score = terminal_score(position)
+    if score is not None:
+        return score
+
+    if cache is not None:
+        score = cache.get(position, SEARCH_LIMIT)
+        if score is None:
+            score = cache.get(position, REFINE_LIMIT)
+        if score is not None:
+            return score
+
+    score = yield REFINE_LIMIT
+    if cache is not None:
+        cache.put(position, REFINE_LIMIT, score)
+    return score
+
+def record_progress():
+    """Counts a unit of analysis work for the lease heartbeat."""
+    global analysis_progress
+    analysis_progress += 1
+
+def record_search(info, seconds):
+    record_progress()
+    nodes = info.get('nodes', 0)
+    metrics.inc('analysis_engine_searches_total')
+    metrics.inc('analysis_engine_nodes_total', nodes)
+    metrics.observe('analysis_engine_search_seconds', seconds)
+    log_event('search', sampled=True, seconds=round(seconds, 4), depth=info.get('depth'),
+              nodes=nodes, nps=round(nodes / seconds) if seconds else None)
+
+def evaluate(engine, position, cache=None, shallow=False):
+    """Returns the white-relative score of the position, searching only when needed."""
+    steps = shallow_steps(position, cache) if shallow else evaluation_steps(position, cache)
+    try:
+        limit = next(steps)
+        while True:
+            started = time.perf_counter()
+            info = engine.analyse(position, limit)
+            record_search(info, time.perf_counter() - started)
+            limit = steps.send(white_cp(info['score']))
+    except StopIteration as done:
+        return done.value
+
+async def evaluate_async(engine, position, cache=None, shallow=False):
+    steps = shallow_steps(position, cache) if shallow else evaluation_steps(position, cache)
+    try:
+        limit = next(steps)
+        while True:
+            started = time.perf_counter()
+            info = await engine.analyse(position, limit)
+            record_search(info, time.perf_counter() - started)
+            limit = steps.send(white_cp(info['score']))
+    except StopIteration as done:
+        return done.value
+
+def shard_positions(positions, count):
+    """Splits positions into at most count contiguous shards of near equal size."""
+    if not positions:
+        return []
+    size = math.ceil(len(positions) / max(1, min(count, len(positions))))
+    return [positions[i:i + size] for i in range(0, len(positions), size)]
+
+class EnginePool:
+    """Runs several UCI engine processes on a background event loop.
+
+    With 'game' parallelism each batch of submitted positions is scored on
+    a single engine so its hash table carries over from ply to ply. With
+    'position' parallelism the positions are sharded across every engine in
+    the pool, which shortens the wall time of long games.
+    """
+
+    def __init__(self, path, size, options=None, parallelism='game', cache=None):
+        if parallelism not in ('game', 'position'):
+            raise ValueError(f"Unknown analysis parallelism: {parallelism}")
+        self.parallelism = parallelism
+        self.cache = cache
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.engines = []
+        try:
+            self._run(self._start(path, size, options or {}))
+        except Exception:
+            self.quit()
+            raise
+
+    def _run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    async def _start(self, path, size, options):
+        self.idle = asyncio.Queue()
+        for _ in range(size):
+            _, engine = await chess.engine.popen_uci(path)
+            self.engines.append(engine)
+            if options:
+                await engine.configure(options)
+            self.idle.put_nowait(engine)
+
+    async def _score_shard(self, positions, shallow):
+        engine = await self.idle.get()
+        try:
+            scores = []
+            for position in positions:
+                scores.append(await evaluate_async(engine, position, self.cache, shallow))
+        finally:
+            self.idle.put_nowait(engine)
+        return scores
+
+    async def _score_positions(self, positions, shallow=False):
+        shards = 1 if self.parallelism == 'game' else len(self.engines)
+        results = await asyncio.gather(*(self._score_shard(shard, shallow)
+                                         for shard in shard_positions(positions, shards)))
+        return [score for shard in results for score in shard]
+
+    def submit_positions(self, positions, shallow=False):
+        """Schedules positions for evaluation and returns a concurrent.futures.Future of their scores."""
+        return asyncio.run_coroutine_threadsafe(self._score_positions(positions, shallow), self.loop)
+
+    async def _quit(self):
+        for engine in self.engines:
+            try:
+                await engine.quit()
+            except Exception as e:
+                log_print("Error quitting pooled engine:", str(e), level='error')
+
+    def quit(self):
+        if self.engines:
+            self._run(self._quit())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+def cpu_features(path='/proc/cpuinfo'):
+    """Returns the CPU feature flags listed in cpuinfo (x86 'flags', ARM 'Features')."""
+    features = set()
+    try:
+        with open(path) as f:
+            for line in f:
+                name, _, value = line.partition(':')
+                if name.strip() in ('flags', 'Features'):
+                    features.update(value.split())
+    except OSError as e:
+        log_print("Error reading CPU features:", str(e), level='error')
+    return features
+
+def supported_builds(builds_dir, features):
+    """Returns the bundled engine builds this CPU can run, fastest first."""
+    try:
+        files = os.listdir(builds_dir)
+    except OSError:
+        return []
+    builds = []
+    for suffix, required in ENGINE_BUILDS:
+        for name in files:
+            if name.endswith(suffix) and name[:-len(suffix)].endswith('-') and required <= features:
+                builds.append(os.path.join(builds_dir, name))
+    return builds
+
+def bench_engine(path, seconds=ENGINE_BENCH_TIME):
+    """Searches a middlegame position for a short time and returns the engine's nodes per second."""
+    bench = chess.engine.SimpleEngine.popen_uci(path)
+    try:
+        info = bench.analyse(chess.Board(BENCH_FEN), chess.engine.Limit(time=seconds))
+    finally:
+        bench.quit()
+    return info.get('nps') or int(info.get('nodes', 0) / max(info.get('time', seconds), 1e-3))
+
+def select_engine_path(builds_dir=ENGINE_BUILDS_DIR, features=None):
+    """Picks the fastest bundled engine build that runs on this node.
+
+    Builds whose CPU requirements are not met are skipped. The rest are
+    benchmarked and the one with the highest nodes per second is chosen;
+    a build that fails to start or search is passed over.
+    """
+    if ENGINE_PATH:
+        return ENGINE_PATH
+    if features is None:
+        features = cpu_features()
+    candidates = supported_builds(builds_dir, features)
+    if not candidates:
+        log_print("No bundled engine builds found in", builds_dir, "- using", DEFAULT_ENGINE_PATH)
+        return DEFAULT_ENGINE_PATH
+
+    results = {}
+    for path in candidates:
+        try:
+            results[path] = bench_engine(path)
+            log_print("Engine build", path, "benchmarked at", results[path], "nodes/s")
+        except Exception as e:
+            log_print("Engine build", path, "failed to benchmark:", str(e))
+    if not results:
+        log_print("No engine build could be benchmarked - using", DEFAULT_ENGINE_PATH)
+        return DEFAULT_ENGINE_PATH
+    path = max(candidates, key=lambda candidate: results.get(candidate, -1))
+    log_print("Selected engine build:", path, "at", results[path], "nodes/s")
+    return path
+
+def engine_identity(engine, path):
+    """Names the engine version, build and options that scores come from."""
+    protocol = engine.engines[0] if isinstance(engine, EnginePool) else engine
+    options = ",".join(f"{name}={value}" for name, value in sorted(engine_options().items()))
+    return f"{protocol.id.get('name', '')}|{os.path.basename(path)}|{options}"
+
+def init_engine(path=None, pool_size=ENGINE_POOL_SIZE, cache=None):
     global engine
     try:
-        log_print("Initializing chess engine from:", path)
-        engine = chess.engine.SimpleEngine.popen_uci(path)
-        log_print("Chess engine initialized.")
+        path = path or select_engine_path()
+        log_print("Initializing chess engine from:", path, "pool size:", pool_size)
+        if pool_size > 1:
+            engine = EnginePool(path, pool_size, engine_options(), ANALYSIS_PARALLELISM, cache)
+        else:
+            engine = chess.engine.SimpleEngine.popen_uci(path)
+            if engine_options():
+                engine.configure(engine_options())
+        if cache is not None:
+            cache.set_engine(engine_identity(engine, path))
+        log_print("Chess engine initialized:", engine_identity(engine, path))
     except Exception as e:
-        log_print("Error initializing chess engine:", str(e))
+        log_print("Error initializing chess engine:", str(e), level='error')
         raise
 
-def signal_handler(signum, frame):
-    global shutdown_flag, message
-    log_print("Signal handler invoked with signal:", signum)
-    try:
-        if message and len(message) > 0:
-            log_print("Changing message visibility for receipt handle:",
-                      message[0]['ReceiptHandle'])
-            response = sqs.change_message_visibility(
+def release_messages(messages, quiet=False):
+    """Makes the messages visible on the queue again so another worker can
+    take them, and returns the ids of the ones that could not be released.
+    Nothing is logged when quiet, as from the signal handler."""
+    failed = []
+    for queued in messages:
+        try:
+            sqs.change_message_visibility(
                 QueueUrl=QUEUE_URL,
-                ReceiptHandle=message[0]['ReceiptHandle'],
+                ReceiptHandle=queued['ReceiptHandle'],
                 VisibilityTimeout=0
             )
-            log_print("ChangeMessageVisibility response:", response)
-    except IndexError:
-        log_print("Error: message list is empty during shutdown.")
-    except Exception as e:
-        log_print("Error during message visibility change:", str(e))
-    
+            if not quiet:
+                log_print("Released message", queued['MessageId'])
+        except Exception as e:
+            failed.append(queued['MessageId'])
+            if not quiet:
+                log_print("Error during message visibility change:", str(e), level='error')
+    return failed
+
+def signal_handler(signum, frame):
+    global shutdown_flag, shutdown_signal, shutdown_releases
+    # Nothing is logged here, as the handler can interrupt a write to stdout;
+    # main logs the signal and the releases once the loop has stopped
     shutdown_flag = True
-    log_print("Shutdown signal received. Shutting down...")
+    shutdown_signal = signum
+    released, failed = list(message or []), []
+    if released:
+        failed += release_messages(released, quiet=True)
+    if prefetcher is not None:
+        held, held_failed = prefetcher.release(quiet=True)
+        released += held
+        failed += held_failed
+    shutdown_releases = (len(released), failed)
 
-def mark_game_as_processed(message_id, game_uuid, processed_games_table):
+def checkpoint_removal(game_uuids):
+    """Returns the REMOVE clause and attribute names that drop the ply
+    checkpoints of the games, so they go with the write marking them processed."""
+    if not game_uuids:
+        return "", {}
+    names = {f"#checkpoint{i}": f"checkpoint:{game_uuid}" for i, game_uuid in enumerate(game_uuids)}
+    return " REMOVE " + ", ".join(names), names
+
+def mark_games_as_processed(message_id, game_uuids, processed_games_table, checkpointed=()):
     try:
-        log_print(f"Marking game {game_uuid} as processed for message {message_id}")
-        response = processed_games_table.update_item(
+        log_print(f"Marking {len(game_uuids)} games as processed for message {message_id}", level='debug')
+        removal, names = checkpoint_removal(checkpointed)
+        update = {}
+        if names:
+            update['ExpressionAttributeNames'] = names
+        processed_games_table.update_item(
             Key={'message_id': message_id},
-            UpdateExpression="SET game_ids = list_append(if_not_exists(game_ids, :empty_list), :game_uuid)",
-            ExpressionAttributeValues={
-                ':empty_list': [],
-                ':game_uuid': [game_uuid]
-            }
+            UpdateExpression="ADD processed_game_ids :game_uuids" + removal,
+            ExpressionAttributeValues={':game_uuids': set(game_uuids)},
+            **update
         )
-        log_print("mark_game_as_processed response:", response)
     except Exception as e:
-        log_print("Error in mark_game_as_processed:", str(e))
+        log_print("Error in mark_games_as_processed:", str(e), level='error')
 
-def get_processed_games(message_id, processed_games_table):
+def save_checkpoint(message_id, game_uuid, scores, processed_games_table):
+    """Records the scores of a game's analyzed plies so a redelivered message resumes after them."""
+    try:
+        processed_games_table.update_item(
+            Key={'message_id': message_id},
+            UpdateExpression="SET #checkpoint = :scores",
+            ExpressionAttributeNames={'#checkpoint': f"checkpoint:{game_uuid}"},
+            ExpressionAttributeValues={':scores': scores}
+        )
+    except Exception as e:
+        log_print("Error checkpointing game", game_uuid, ":", str(e), level='error')
+
+def get_message_progress(message_id, processed_games_table):
+    """Returns the processed game ids, flushed stats entries and per-game
+    ply checkpoints recorded for a message."""
     try:
-        log_print("Getting list of processed games for message ID:", message_id)
         response = processed_games_table.get_item(Key={'message_id': message_id})
-        log_print("DynamoDB get_item response:", response)
     except Exception as e:
-        log_print("Error fetching processed games for message", message_id, ":", str(e))
-        return []
-    processed_games = response.get('Item', {}).get('game_ids', [])
-    log_print("Processed games:", processed_games)
-    return processed_games
-
-def update_player_stats(player, stats, year, month, game_info, player_stats_table, total_games_increment):
-    keys = {'username': player}
-    log_print(f"Updating stats for player {player}")
-
-    # Initialize paths for maps
-    initialize_map_paths = [
-        "SET game_stats = if_not_exists(game_stats, :empty_map)",
-        f"SET game_stats.{year} = if_not_exists(game_stats.{year}, :empty_map)",
-        f"SET game_stats.{year}.player_total = if_not_exists(game_stats.{year}.player_total, :empty_map)",
-        f"SET game_stats.{year}.worst_game = if_not_exists(game_stats.{year}.worst_game, :empty_map)",
-        f"SET game_stats.{year}.{month} = if_not_exists(game_stats.{year}.{month}, :empty_map)",
-        f"SET game_stats.{year}.{month}.player_total = if_not_exists(game_stats.{year}.{month}.player_total, :empty_map)",
-        f"SET game_stats.{year}.{month}.worst_game = if_not_exists(game_stats.{year}.{month}.worst_game, :empty_map)"
-    ]
+        log_print("Error fetching processed games for message", message_id, ":", str(e), level='error')
+        return set(), set(), {}
+    item = response.get('Item', {})
+    # Items written before processed games were tracked in a string set hold a game_ids list
+    processed_games = set(item.get('processed_game_ids', set())) | set(item.get('game_ids', []))
+    log_print("Processed games:", len(processed_games), level='debug')
+    checkpoints = {name.split(':', 1)[1]: [int(score) for score in scores]
+                   for name, scores in item.items() if name.startswith('checkpoint:')}
+    return processed_games, set(item.get('flushed_entries', set())), checkpoints
 
-    initialize_zero_paths = [
-        f"SET game_stats.{year}.total_games = if_not_exists(game_stats.{year}.total_games, :zero)",
-        f"SET game_stats.{year}.{month}.total_games = if_not_exists(game_stats.{year}.{month}.total_games, :zero)"
-    ]
+def get_processed_games(message_id, processed_games_table):
+    return get_message_progress(message_id, processed_games_table)[0]
 
-    for expr in initialize_map_paths:
-        try:
-            log_print(f"Updating (map init) for {player} using expression: {expr}")
-            response = player_stats_table.update_item(
-                Key=keys,
-                UpdateExpression=expr,
-                ExpressionAttributeValues={":empty_map": {}}
-            )
-            log_print("Map initialization response:", response)
-        except Exception as e:
-            log_print("Error during map initialization for", player, ":", str(e))
+def get_tracked_players(player_stats_table, ttl=ROSTER_TTL):
+    """Returns the usernames in PlayerStats, scanned once and cached for ttl
+    seconds, or None when the roster cannot be loaded. Only a drain mode
+    worker handles enough messages to pay for the scan."""
+    global tracked_roster
+    now = time.monotonic()
+    if tracked_roster is not None:
+        table, loaded_at, players = tracked_roster
+        if table is player_stats_table and now - loaded_at < ttl:
+            return players
 
-    for expr in initialize_zero_paths:
-        try:
-            log_print(f"Updating (zero init) for {player} using expression: {expr}")
-            response = player_stats_table.update_item(
-                Key=keys,
-                UpdateExpression=expr,
-                ExpressionAttributeValues={":zero": 0}
-            )
-            log_print("Zero initialization response:", response)
-        except Exception as e:
-            log_print("Error during zero initialization for", player, ":", str(e))
+    players = set()
+    kwargs = {'ProjectionExpression': 'username'}
+    try:
+        while True:
+            response = player_stats_table.scan(**kwargs)
+            players.update(item['username'] for item in response.get('Items', []))
+            if 'LastEvaluatedKey' not in response:
+                break
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    except Exception as e:
+        log_print("Error loading tracked players:", str(e), level='error')
+        return None
+    log_print("Loaded", len(players), "tracked players")
+    tracked_roster = (player_stats_table, now, players)
+    return players
 
+def lookup_tracked_players(usernames, player_stats_table):
+    """Returns which of the usernames are in PlayerStats, read with
+    BatchGetItem, or None when they cannot be looked up."""
+    players = set()
+    keys = [{'username': username} for username in sorted(usernames)]
     try:
-        update_expression = f"ADD game_stats.{year}.total_games :inc_games, game_stats.{year}.{month}.total_games :inc_games"
-        log_print(f"Updating total_games for {player} using expression: {update_expression}")
-        response = player_stats_table.update_item(
-            Key=keys,
-            UpdateExpression=update_expression,
-            ExpressionAttributeValues={":inc_games": total_games_increment}
-        )
-        log_print("Total games update response:", response)
+        for i in range(0, len(keys), 100):
+            request = {player_stats_table.name: {'Keys': keys[i:i + 100], 'ProjectionExpression': 'username'}}
+            while request:
+                response = player_stats_table.meta.client.batch_get_item(RequestItems=request)
+                players.update(item['username'] for item in response.get('Responses', {}).get(player_stats_table.name, []))
+                request = response.get('UnprocessedKeys')
     except Exception as e:
-        log_print("Error updating total_games for", player, ":", str(e))
+        log_print("Error looking up tracked players:", str(e), level='error')
+        return None
+    return players
+
+def error_code(e):
+    return e.response.get('Error', {}).get('Code') if isinstance(e, ClientError) else None
+
+def ensure_stats_maps(player, stats, year, month, player_stats_table, tracked_only):
+    """Creates the yearly and monthly maps a player's counters are added to.
 
-    for stat, increment in stats.items():
+    Each level is created whole with a conditional write, from game_stats
+    down, so concurrent pods cannot clobber each other's maps. If every
+    level exists, missing counters inside them are filled in instead.
+    """
+    zero_period = {'total_games': 0, 'player_total': {stat: 0 for stat in stats}, 'worst_game': {}}
+    year_map = dict(zero_period, **{month: zero_period})
+    exists = "attribute_exists(username) AND " if tracked_only else ""
+    levels = [
+        ("SET game_stats = :map", "attribute_not_exists(game_stats)", {year: year_map}),
+        (f"SET game_stats.{year} = :map", f"attribute_not_exists(game_stats.{year})", year_map),
+        (f"SET game_stats.{year}.{month} = :map", f"attribute_not_exists(game_stats.{year}.{month})", zero_period),
+    ]
+    for update_expression, condition, value in levels:
         try:
-            yearly_path = f"game_stats.{year}.player_total.{stat}"
-            monthly_path = f"game_stats.{year}.{month}.player_total.{stat}"
-            update_expression = f"ADD {yearly_path} :inc, {monthly_path} :inc"
-            log_print(f"Updating stat '{stat}' for {player} using expression: {update_expression}")
-            response = player_stats_table.update_item(
-                Key=keys,
+            player_stats_table.update_item(
+                Key={'username': player},
                 UpdateExpression=update_expression,
-                ExpressionAttributeValues={":inc": increment}
+                ConditionExpression=exists + condition,
+                ExpressionAttributeValues={":map": value}
             )
-            log_print(f"Update response for stat '{stat}' for {player}:", response)
-        except Exception as e:
-            log_print(f"Error updating stat '{stat}' for {player}:", str(e))
+            log_print(f"Created stats map for {player} using expression: {update_expression}")
+            return
+        except ClientError as e:
+            if error_code(e) != 'ConditionalCheckFailedException':
+                raise
 
+    fields = [f"{period}.{name} = if_not_exists({period}.{name}, :{name})"
+              for period in (f"game_stats.{year}", f"game_stats.{year}.{month}")
+              for name in ('total_games', 'player_total', 'worst_game')]
+    kwargs = {
+        'Key': {'username': player},
+        'UpdateExpression': "SET " + ", ".join(fields),
+        'ExpressionAttributeValues': {":total_games": 0, ":player_total": {}, ":worst_game": {}}
+    }
+    if tracked_only:
+        kwargs['ConditionExpression'] = "attribute_exists(username)"
+    player_stats_table.update_item(**kwargs)
+
+def update_worst_game(player, path, game_info, player_stats_table):
     try:
-        log_print(f"Fetching current stats for {player}")
-        response = player_stats_table.get_item(Key=keys)
-        log_print("Current stats get_item response:", response)
-    except Exception as e:
-        log_print("Error fetching current stats for", player, ":", str(e))
-        response = {}
-    item = response.get('Item', {})
-    game_stats = item.get('game_stats', {})
-    year_stats = game_stats.get(year, {})
-    month_stats = year_stats.get(month, {})
+        player_stats_table.update_item(
+            Key={'username': player},
+            UpdateExpression=f"SET {path} = :game_info",
+            ConditionExpression=f"attribute_not_exists({path}.magnitude) OR {path}.magnitude < :magnitude",
+            ExpressionAttributeValues={":game_info": game_info, ":magnitude": game_info['magnitude']}
+        )
+        return True
+    except ClientError as e:
+        if error_code(e) == 'ConditionalCheckFailedException':
+            return False
+        raise
+
+def player_counters_update(player, periods, player_stats_table):
+    """Builds one transactional ADD of a player's counters for every (year, month) they played in."""
+    increments = {}
+    for year, month, entry in periods:
+        for period in (f"game_stats.{year}", f"game_stats.{year}.{month}"):
+            increments[f"{period}.total_games"] = increments.get(f"{period}.total_games", 0) + entry['total_games']
+            for stat, increment in entry['stats'].items():
+                path = f"{period}.player_total.{stat}"
+                increments[path] = increments.get(path, 0) + increment
+    return {'Update': {
+        'TableName': player_stats_table.name,
+        'Key': {'username': player},
+        'UpdateExpression': "ADD " + ", ".join(f"{path} :v{i}" for i, path in enumerate(increments)),
+        'ConditionExpression': "attribute_exists(username)",
+        'ExpressionAttributeValues': {f":v{i}": increment for i, increment in enumerate(increments.values())}
+    }}
+
+def write_stats_transaction(message_id, marker, players, game_uuids, player_stats_table, processed_games_table,
+                            checkpointed=()):
+    """Adds the players' counters and records the marker, and the processed
+    games, on the message's ProcessedGames item in a single transaction.
+    The ply checkpoints of the checkpointed games are removed in it too.
+
+    The marker write is conditional on the marker being new, so a batch is
+    counted exactly once however often it is replayed. Maps missing for a
+    new month are created outside the transaction for the players whose
+    update was cancelled, and players that are not tracked are dropped
+    from it. Returns the players whose counters were written, or None when
+    the marker was already recorded. Any other failure is raised.
+    """
+    players = dict(players)
+    marker_values = {':marker': {marker}, ':marker_id': marker}
+    marker_expression = "ADD flushed_entries :marker"
+    if game_uuids:
+        marker_values[':games'] = set(game_uuids)
+        marker_expression += ", processed_game_ids :games"
+    removal, names = checkpoint_removal(checkpointed)
+    marker_update = {'Update': {
+        'TableName': processed_games_table.name,
+        'Key': {'message_id': message_id},
+        'UpdateExpression': marker_expression + removal,
+        'ConditionExpression': "NOT contains(flushed_entries, :marker_id)",
+        'ExpressionAttributeValues': marker_values
+    }}
+    if names:
+        marker_update['Update']['ExpressionAttributeNames'] = names
+    ensured = set()
 
-    yearly_worst_game = year_stats.get('worst_game', {'magnitude': -1})
-    monthly_worst_game = month_stats.get('worst_game', {'magnitude': -1})
+    def ensure_maps(names):
+        for player in names:
+            ensured.add(player)
+            try:
+                for year, month, entry in players[player]:
+                    ensure_stats_maps(player, entry['stats'], year, month, player_stats_table, True)
+            except ClientError as ensure_error:
+                if error_code(ensure_error) != 'ConditionalCheckFailedException':
+                    raise
+                log_print(f"Player {player} not found in database. Skipping...", level='debug')
+                del players[player]
 
-    if game_info['magnitude'] > yearly_worst_game.get('magnitude', -1):
+    while True:
+        items = [player_counters_update(player, periods, player_stats_table) for player, periods in players.items()]
         try:
-            update_expression = f"SET game_stats.{year}.worst_game = :game_info"
-            log_print(f"Updating yearly worst game for {player} using expression: {update_expression}")
-            response = player_stats_table.update_item(
-                Key=keys,
-                UpdateExpression=update_expression,
-                ExpressionAttributeValues={":game_info": game_info}
+            player_stats_table.meta.client.transact_write_items(TransactItems=items + [marker_update])
+            return set(players)
+        except ClientError as e:
+            if error_code(e) != 'TransactionCanceledException':
+                raise
+            reasons = [reason.get('Code') for reason in e.response.get('CancellationReasons', [])]
+            if reasons and reasons[-1] == 'ConditionalCheckFailed':
+                log_print("Stats batch", marker, "was already written. Skipping...")
+                return None
+            failed = dict(zip(list(players), reasons))
+            untracked = [player for player, reason in failed.items() if reason == 'ConditionalCheckFailed']
+            # DynamoDB cancels the update of a player whose yearly or monthly map does not exist yet
+            missing = [player for player, reason in failed.items() if reason == 'ValidationError' and player not in ensured]
+            if not untracked and not missing:
+                raise
+            for player in untracked:
+                log_print(f"Player {player} not found in database. Skipping...", level='debug')
+                del players[player]
+            ensure_maps(missing)
+
+class StatsAggregator:
+    """Accumulates player stats across the games of a message.
+
+    Deltas are kept per player and (year, month), along with the worst game
+    of each. When flushed, every player's counters are added in one
+    transaction per TRANSACTION_PLAYERS players, together with a marker on
+    the message's ProcessedGames item; the last transaction also marks the
+    batch's games processed and drops their ply checkpoints. A redelivered
+    or concurrently processed message therefore never counts a batch
+    twice. A failed write is raised so the message is left on the queue
+    for redelivery. Players missing from the roster, when one is given,
+    are left out of the transactions, whose tracked-player condition
+    would otherwise cancel them.
+
+    With a results sink the per-game records are emitted to it instead and
+    a reducer applies them to PlayerStats later. The reducer tracks its
+    games itself, so with track_games off they are not added to the item.
+    """
+
+    def __init__(self, message_id, flushed_entries=None, sink=None, track_games=True, roster=None):
+        self.message_id = message_id
+        self.flushed_entries = set(flushed_entries or ())
+        self.sink = sink
+        self.track_games = track_games
+        self.roster = roster
+        self.entries = {}
+        self.games = []
+        self.records = []
+        self.checkpointed = set()
+
+    def add_game(self, game, game_stats):
+        end_time = datetime.fromtimestamp(game['end_time'], timezone.utc)
+        year = f'y{end_time.year}'
+        month = f'm{end_time.month:02}'
+
+        players = {'white': game['white'], 'black': game['black']}
+        for colour, player in players.items():
+            if self.roster is not None and player not in self.roster:
+                continue
+            current_stats = game_stats[colour]
+            game_magnitude = current_stats['blunders'] * 3 + current_stats['mistakes'] * 2 + current_stats['inaccuracies']
+            game_info = {
+                'game_url': game['game_url'],
+                'magnitude': game_magnitude,
+                'stats': current_stats
+            }
+            entry = self.entries.setdefault((player, year, month), {
+                'stats': {stat: 0 for stat in current_stats},
+                'total_games': 0,
+                'worst_game': game_info
+            })
+            for stat, increment in current_stats.items():
+                entry['stats'][stat] += increment
+            entry['total_games'] += 1
+            if game_magnitude > entry['worst_game']['magnitude']:
+                entry['worst_game'] = game_info
+        self.games.append(game['game_uuid'])
+        self.records.append({key: game[key] for key in ('game_uuid', 'white', 'black', 'end_time', 'game_url')}
+                            | {'message_id': self.message_id, 'stats': game_stats})
+
+    def batch_id(self):
+        # Batches are cut from the same unprocessed games on redelivery, so
+        # their id only depends on the games they hold
+        return hashlib.sha1(",".join(sorted(self.games)).encode()).hexdigest()[:16]
+
+    def flush(self, player_stats_table, processed_games_table):
+        if not self.games:
+            return
+        if self.sink is not None:
+            log_print(f"Emitting results for {len(self.games)} games to the results sink")
+            self.sink.emit(self.records)
+            mark_games_as_processed(self.message_id, self.games, processed_games_table,
+                                    [game_uuid for game_uuid in self.games if game_uuid in self.checkpointed])
+            self.entries = {}
+            self.games = []
+            self.records = []
+            return
+
+        batch_id = self.batch_id()
+        players = {}
+        for (player, year, month), entry in sorted(self.entries.items()):
+            players.setdefault(player, []).append((year, month, entry))
+        names = sorted(players)
+        # A batch with no tracked players still records its marker and games
+        chunks = [names[i:i + TRANSACTION_PLAYERS] for i in range(0, len(names), TRANSACTION_PLAYERS)] or [[]]
+        log_print(f"Flushing stats for {len(self.games)} games as {len(self.entries)} player entries "
+                  f"in {len(chunks)} transactions")
+        for i, chunk in enumerate(chunks):
+            marker = f"{batch_id}:{i}"
+            if marker in self.flushed_entries:
+                log_print("Skipping already flushed stats batch:", marker)
+                continue
+            try:
+                written = write_stats_transaction(self.message_id, marker, {player: players[player] for player in chunk},
+                                                  self.games if self.track_games and i == len(chunks) - 1 else [],
+                                                  player_stats_table, processed_games_table,
+                                                  [game_uuid for game_uuid in self.games if game_uuid in self.checkpointed]
+                                                  if i == len(chunks) - 1 else [])
+            except Exception as e:
+                # The batch's games are only marked processed by the last
+                # chunk, so the redelivered message replays every unwritten chunk
+                log_print("Error writing stats batch", marker, ":", str(e), level='error')
+                raise
+            # Worst games only ever move up, so they are safe to write again after a replay
+            for player in chunk if written is None else written:
+                for year, month, entry in players[player]:
+                    for path in (f"game_stats.{year}.worst_game", f"game_stats.{year}.{month}.worst_game"):
+                        try:
+                            update_worst_game(player, path, entry['worst_game'], player_stats_table)
+                        except Exception as e:
+                            log_print("Error updating worst game for", player, "at", path, ":", str(e), level='error')
+        self.entries = {}
+        self.games = []
+        self.records = []
+
+class SqsResultSink:
+    """Sends per-game result records to an SQS queue, one message per flush."""
+
+    def __init__(self, sqs, queue_url, max_receives=REDUCER_MAX_RECEIVES):
+        self.sqs = sqs
+        self.queue_url = queue_url
+        self.max_receives = max_receives
+
+    def emit(self, records):
+        self.sqs.send_message(QueueUrl=self.queue_url, MessageBody=json.dumps(records))
+
+    def read(self):
+        """Returns every queued batch of records with a callback that deletes it."""
+        batches = []
+        for _ in range(self.max_receives):
+            response = self.sqs.receive_message(
+                QueueUrl=self.queue_url,
+                MaxNumberOfMessages=10,
+                WaitTimeSeconds=1,
+                VisibilityTimeout=900
             )
-            log_print("Yearly worst game update response:", response)
-        except Exception as e:
-            log_print("Error updating yearly worst game for", player, ":", str(e))
+            messages = response.get('Messages', [])
+            if not messages:
+                break
+            for queued in messages:
+                batches.append((json.loads(queued['Body']),
+                                lambda handle=queued['ReceiptHandle']: self.sqs.delete_message(
+                                    QueueUrl=self.queue_url, ReceiptHandle=handle)))
+        return batches
+
+class FileResultSink:
+    """Writes per-game result records to JSON files in a local directory."""
 
-    if game_info['magnitude'] > monthly_worst_game.get('magnitude', -1):
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def emit(self, records):
+        name = f"{time.time_ns()}-{uuid.uuid4().hex}.json"
+        path = os.path.join(self.directory, name)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(records, f)
+        os.replace(path + '.tmp', path)
+
+    def read(self):
+        batches = []
+        for name in sorted(os.listdir(self.directory)):
+            if name.endswith('.json'):
+                path = os.path.join(self.directory, name)
+                with open(path) as f:
+                    batches.append((json.load(f), lambda path=path: os.remove(path)))
+        return batches
+
+class MemoryResultSink:
+    """Keeps per-game result records in memory, for tests."""
+
+    def __init__(self):
+        self.batches = []
+
+    def emit(self, records):
+        self.batches.append(json.loads(json.dumps(records)))
+
+    def read(self):
+        return [(records, lambda records=records: self.batches.remove(records)) for records in list(self.batches)]
+
+def init_result_sink(kind=STATS_SINK):
+    global result_sink
+    result_sink = None
+    if kind == 'sqs':
+        result_sink = SqsResultSink(sqs, RESULTS_QUEUE_URL)
+    elif kind == 'file':
+        result_sink = FileResultSink(RESULTS_DIR)
+    elif kind != 'dynamodb':
+        log_print("Unknown stats sink:", kind, "- writing PlayerStats directly")
+    log_print("Stats sink:", kind if result_sink is not None else 'dynamodb')
+
+def get_reducer_claims(game_uuids, processed_games_table):
+    """Returns the reducer run that claimed each of the games, for the games already claimed."""
+    claims = {}
+    keys = [{'message_id': f"stats-reducer#game#{game_uuid}"} for game_uuid in game_uuids]
+    for i in range(0, len(keys), 100):
+        request = {processed_games_table.name: {'Keys': keys[i:i + 100]}}
+        while request:
+            response = processed_games_table.meta.client.batch_get_item(RequestItems=request)
+            for item in response.get('Responses', {}).get(processed_games_table.name, []):
+                claims[item['message_id'].split('#', 2)[2]] = item['run_id']
+            request = response.get('UnprocessedKeys')
+    return claims
+
+def claim_games(run_id, game_uuids, processed_games_table):
+    """Claims the games for a reducer run with a conditional marker item per
+    game and returns the ones claimed; games another run claimed first are left out."""
+    claimed = []
+    for game_uuid in game_uuids:
         try:
-            update_expression = f"SET game_stats.{year}.{month}.worst_game = :game_info"
-            log_print(f"Updating monthly worst game for {player} using expression: {update_expression}")
-            response = player_stats_table.update_item(
-                Key=keys,
-                UpdateExpression=update_expression,
-                ExpressionAttributeValues={":game_info": game_info}
+            processed_games_table.put_item(
+                Item={'message_id': f"stats-reducer#game#{game_uuid}", 'run_id': run_id},
+                ConditionExpression="attribute_not_exists(message_id) OR run_id = :run_id",
+                ExpressionAttributeValues={':run_id': run_id}
             )
-            log_print("Monthly worst game update response:", response)
-        except Exception as e:
-            log_print("Error updating monthly worst game for", player, ":", str(e))
+            claimed.append(game_uuid)
+        except ClientError as e:
+            if error_code(e) != 'ConditionalCheckFailedException':
+                raise
+    return claimed
 
-    log_print(f"Updated stats for {player} in {month}/{year}: {stats}")
+def reduce_results(sink, player_stats_table, processed_games_table):
+    """Merges every pending result record per player and period and applies
+    one PlayerStats write per entry.
 
-def fetch_message():
-    global message
+    Games are counted exactly once by game_uuid: a run records its games on
+    its item and then claims each with a marker naming the run. A game
+    whose run finished is skipped, even when a redelivered worker message
+    emits it again. A run that failed is only finished once a read returns
+    every game it claimed, so its per-chunk markers line up with the
+    entries it already wrote. Records are only deleted from the sink once
+    every game in them has been counted. A failed write is raised and
+    nothing is deleted.
+    """
+    batches = sink.read()
+    games = {}
+    for records, _ in batches:
+        for record in records:
+            games.setdefault(record['game_uuid'], record)
+    if not games:
+        log_print("No result records to reduce.")
+        return 0
+
+    claims = get_reducer_claims(list(games), processed_games_table)
+    unclaimed = sorted(game_uuid for game_uuid in games if game_uuid not in claims)
+    if unclaimed:
+        run_id = hashlib.sha1(",".join(unclaimed).encode()).hexdigest()[:16]
+        # Recorded before the claims, so a retry knows every game the run may hold
+        processed_games_table.update_item(Key={'message_id': f"stats-reducer#{run_id}"},
+                                          UpdateExpression="ADD game_uuids :games",
+                                          ExpressionAttributeValues={':games': set(unclaimed)})
+        claims.update((game_uuid, run_id) for game_uuid in claim_games(run_id, unclaimed, processed_games_table))
+    runs = {}
+    for game_uuid, run_id in claims.items():
+        runs.setdefault(run_id, []).append(game_uuid)
+
+    reduced = 0
+    complete = set()
+    for run_id, game_uuids in sorted(runs.items()):
+        run_key = {'message_id': f"stats-reducer#{run_id}"}
+        item = processed_games_table.get_item(Key=run_key).get('Item', {})
+        if item.get('complete'):
+            log_print(f"Skipping {len(game_uuids)} games already reduced by run {run_id}")
+            complete.add(run_id)
+            continue
+        # A recorded game that another run claimed first is counted by that run
+        run_games = sorted(game_uuid for game_uuid, claimant
+                           in get_reducer_claims(sorted(item.get('game_uuids', set())), processed_games_table).items()
+                           if claimant == run_id)
+        missing = [game_uuid for game_uuid in run_games if game_uuid not in games]
+        if missing:
+            log_print(f"Run {run_id} is missing {len(missing)} of its {len(run_games)} games from this read, "
+                      "leaving it to the next reduce", level='warning')
+            continue
+        aggregator = StatsAggregator(run_key['message_id'], item.get('flushed_entries'), track_games=False)
+        for game_uuid in run_games:
+            aggregator.add_game(games[game_uuid], games[game_uuid]['stats'])
+        aggregator.flush(player_stats_table, processed_games_table)
+        processed_games_table.update_item(Key=run_key, UpdateExpression="SET complete = :complete",
+                                          ExpressionAttributeValues={':complete': True})
+        complete.add(run_id)
+        reduced += len(run_games)
+
+    acked = 0
+    for records, ack in batches:
+        if all(claims.get(record['game_uuid']) in complete for record in records):
+            ack()
+            acked += 1
+    log_print(f"Reduced {reduced} games, deleted {acked} of {len(batches)} result batches")
+    return reduced
+
+def receive_messages(max_messages=1):
     try:
-        log_print("Fetching message from SQS. Queue URL:", QUEUE_URL)
         response = sqs.receive_message(
             QueueUrl=QUEUE_URL,
-            MaxNumberOfMessages=1,
-            WaitTimeSeconds=20,
-            VisibilityTimeout=7200  # 2 hours
+            MaxNumberOfMessages=max_messages,
+            WaitTimeSeconds=RECEIVE_WAIT_SECONDS,
+            VisibilityTimeout=VISIBILITY_TIMEOUT
         )
-        log_print("SQS receive_message response:", response)
+        log_print("Received", len(response.get('Messages', [])), "messages from SQS", level='debug')
     except Exception as e:
-        log_print("Error fetching message from SQS:", str(e))
+        log_print("Error fetching message from SQS:", str(e), level='error')
         response = {}
-    message = response.get('Messages', [])
+    return response.get('Messages', [])
+
+def fetch_message(max_messages=1):
+    global message
+    message = receive_messages(max_messages)
     if not message:
         log_print("No messages received from SQS.")
 
+class MessagePrefetcher:
+    """Receives the next messages on a background thread while the current
+    one is analyzed, keeping up to `size` messages in hand.
+
+    The heartbeat keeps the messages in hand leased while they wait, and
+    each is leased again when it is taken. A message whose lease lapsed in
+    the meantime may already be with another worker, so it is dropped.
+    """
+
+    def __init__(self, size=1):
+        self.size = size
+        self.condition = threading.Condition()
+        self.ready = []
+        self.empty = False
+        self.stopped = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.stopped and (self.ready or self.empty):
+                    self.condition.wait()
+                if self.stopped:
+                    return
+            received = receive_messages(self.size)
+            with self.condition:
+                if not self.stopped:
+                    self.ready = received
+                    self.empty = not received
+                    self.condition.notify_all()
+                    continue
+            release_messages(received)
+            return
+
+    def take(self):
+        """Returns the messages in hand, waiting for a receive in flight, and
+        starts prefetching the next ones. An empty list means the queue is empty."""
+        while True:
+            with self.condition:
+                while not self.stopped and not self.ready and not self.empty:
+                    self.condition.wait()
+                taken, self.ready = self.ready, []
+                self.condition.notify_all()
+            leased = [queued for queued in taken if renew_lease(queued)]
+            if leased or not taken:
+                return leased
+            log_print("Lost the lease on every prefetched message, receiving again.")
+
+    def held(self):
+        with self.condition:
+            return list(self.ready)
+
+    def release(self, quiet=False):
+        """Stops prefetching and makes the messages in hand visible again.
+        Returns them with the ids of the ones that could not be released."""
+        with self.condition:
+            self.stopped = True
+            held, self.ready = self.ready, []
+            self.condition.notify_all()
+        if not held:
+            return [], []
+        if not quiet:
+            log_print("Releasing", len(held), "prefetched messages.")
+        return held, release_messages(held, quiet)
+
+def renew_lease(queued):
+    """Leases the message for another VISIBILITY_TIMEOUT seconds; returns False if that failed."""
+    try:
+        sqs.change_message_visibility(
+            QueueUrl=QUEUE_URL,
+            ReceiptHandle=queued['ReceiptHandle'],
+            VisibilityTimeout=VISIBILITY_TIMEOUT
+        )
+        return True
+    except Exception as e:
+        log_print("Error renewing lease of message", queued['MessageId'], ":", str(e), level='error')
+        return False
+
 def delete_message(receipt_handle, sqs):
     try:
-        log_print("Deleting SQS message with receipt handle:", receipt_handle)
-        response = sqs.delete_message(
+        sqs.delete_message(
             QueueUrl=QUEUE_URL,
             ReceiptHandle=receipt_handle
         )
-        log_print("SQS delete_message response:", response)
     except Exception as e:
-        log_print("Error deleting SQS message:", str(e))
+        log_print("Error deleting SQS message:", str(e), level='error')
 
-def analyze_moves(moves, engine, board):
-    stats = {'white': {'inaccuracies': 0, 'mistakes': 0, 'blunders': 0},
-             'black': {'inaccuracies': 0, 'mistakes': 0, 'blunders': 0}}
+def winning_chances(cp):
+    MULTIPLIER = -0.00368208
+    return 1 / (1 + math.exp(MULTIPLIER * cp))
 
-    def winning_chances(cp):
-        MULTIPLIER = -0.00368208
-        return 1 / (1 + math.exp(MULTIPLIER * cp))
+def white_cp(score):
+    return score.white().score(mate_score=MATE_SCORE)
 
-    for i, move_san in enumerate(moves):
-        player = 'white' if i % 2 == 0 else 'black'
+def replay_positions(moves, board):
+    """Plays the SAN moves on the board and returns a copy of every position
+    reached, starting position included."""
+    positions = [board.copy()]
+    for move_san in moves:
         try:
-            log_print(f"Analyzing move {i+1} for {player}: {move_san}")
-            info_before = engine.analyse(board, chess.engine.Limit(depth=20))
-            score_before = info_before['score']
-            cp_before = score_before.white().score(mate_score=10000) if player == 'white' else score_before.black().score(mate_score=10000)
-            
-            move = board.parse_san(move_san)
-            board.push(move)
-            log_print("Applied move:", move_san)
-            
-            info_after = engine.analyse(board, chess.engine.Limit(depth=20))
-            score_after = info_after['score']
-            cp_after = int(score_after.white().score(mate_score=10000)) if player == 'white' else int(score_after.black().score(mate_score=10000))
-            
-            wp_before = winning_chances(cp_before)
-            wp_after = winning_chances(cp_after)
-            win_prob_change = abs(wp_after - wp_before)
-            log_print(f"Win probability change for {player}: {win_prob_change:.4f}")
-            
-            if win_prob_change >= 0.2:
-                stats[player]['blunders'] += 1
-            elif win_prob_change >= 0.1:
-                stats[player]['mistakes'] += 1
-            elif win_prob_change >= 0.05:
-                stats[player]['inaccuracies'] += 1
+            board.push(board.parse_san(move_san))
         except (chess.InvalidMoveError, chess.IllegalMoveError, chess.AmbiguousMoveError) as e:
-            log_print("Move error for", move_san, ":", str(e))
+            log_print("Move error for", move_san, ":", str(e), level='warning')
             raise
+        positions.append(board.copy())
+    return positions
+
+def win_prob_changes(scores, tablebase_scores=None):
+    """Returns the win probability change of every ply. Plies with a
+    tablebase score on both sides are measured on the tablebase scores,
+    the rest on the engine scores."""
+    # winning_chances(-cp) == 1 - winning_chances(cp), so the change is the
+    # same from either player's perspective
+    exact = tablebase_plies(tablebase_scores) if tablebase_scores is not None else set()
+    changes = []
+    for i in range(len(scores) - 1):
+        pair = tablebase_scores if i in exact else scores
+        changes.append(abs(winning_chances(pair[i + 1]) - winning_chances(pair[i])))
+    return changes
+
+def classify_moves(scores, first_ply=0, tablebase_scores=None):
+    """Classifies every move from the white-relative centipawn scores of the
+    positions before and after it. first_ply is the ply of the first move,
+    when the scores start after the opening book."""
+    stats = {'white': {'inaccuracies': 0, 'mistakes': 0, 'blunders': 0},
+             'black': {'inaccuracies': 0, 'mistakes': 0, 'blunders': 0}}
+
+    for i, win_prob_change in enumerate(win_prob_changes(scores, tablebase_scores), first_ply):
+        player = 'white' if i % 2 == 0 else 'black'
+        log_event('ply', sampled=True, ply=i + 1, player=player,
+                  win_prob_change=round(win_prob_change, 4))
+
+        for stat, threshold in CLASSIFICATION_THRESHOLDS:
+            if win_prob_change >= threshold:
+                stats[player][stat] += 1
+                break
     return stats
 
-def process_message(message, engine, player_stats_table, processed_games_table, sqs):
+def near_cutoff_plies(scores, margin=REFINE_MARGIN, tablebase_scores=None):
+    """Returns the engine-scored plies whose win probability change lies
+    within margin of a classification cutoff."""
+    exact = tablebase_plies(tablebase_scores) if tablebase_scores is not None else set()
+    return [i for i, change in enumerate(win_prob_changes(scores, tablebase_scores))
+            if i not in exact and any(abs(change - threshold) <= margin for _, threshold in CLASSIFICATION_THRESHOLDS)]
+
+def score_positions(engine, positions, cache=None, shallow=False):
+    if isinstance(engine, EnginePool):
+        return engine.submit_positions(positions, shallow).result()
+    return [evaluate(engine, position, cache, shallow) for position in positions]
+
+def refine_scores(keys, positions, scores, refined, engine, cache=None, tablebase_scores=None):
+    """Re-searches at full depth both positions of every ply near a cutoff.
+
+    Refining a position also moves the change of its neighbouring ply, so
+    this repeats until every ply near a cutoff has been searched at full
+    depth. scores maps position keys to their best known score and refined
+    holds the keys already searched at full depth; both are updated in
+    place. Plies scored from the tablebase are exact and never refined.
+    Returns the number of plies that were refined.
+    """
+    refined_plies = set()
+    while True:
+        targets = {}
+        for ply in near_cutoff_plies([scores.get(key) for key in keys], tablebase_scores=tablebase_scores):
+            for i in (ply, ply + 1):
+                if keys[i] not in refined:
+                    targets[keys[i]] = positions[i]
+                    refined_plies.add(ply)
+        if not targets:
+            return len(refined_plies)
+        scores.update(zip(targets, score_positions(engine, list(targets.values()), cache)))
+        refined.update(targets)
+
+def analyze_moves(moves, engine, board, cache=None):
+    # The position after ply N is the position before ply N+1, so each
+    # distinct position is searched once and read from both perspectives
+    positions = replay_positions(moves, board)
+    book_plies = count_book_plies(positions, opening_book)
+    if book_plies:
+        log_print(f"Skipping {book_plies} book plies")
+        positions = positions[book_plies:]
+    tablebase_scores = [tablebase_score(position) for position in positions]
+    keys = [i for i, search in enumerate(needs_search(tablebase_scores)) if search]
+
+    scores = dict(zip(keys, score_positions(engine, [positions[i] for i in keys], cache,
+                                            shallow=REFINE_LIMIT is not None)))
+    if REFINE_LIMIT is not None:
+        refined_plies = refine_scores(list(range(len(positions))), positions, scores, set(), engine, cache,
+                                      tablebase_scores)
+        log_print(f"Refined {refined_plies} of {len(positions) - 1} plies at full depth")
+    return classify_moves([scores.get(i) for i in range(len(positions))], book_plies, tablebase_scores)
+
+def plan_games(games, book=None):
+    """Expands the games of a message into positions and deduplicates them.
+
+    Games are ordered by their move lists, which walks the shared-prefix
+    trie of the message depth first: shared openings come first and
+    consecutive searches stay in related positions, keeping the engine's
+    hash table warm. Each plan lists the Zobrist key and tablebase score
+    of every position from the first out-of-book position on, and the
+    positions needing a search that are first reached in that game, which
+    are the only ones that still need evaluating when it comes up.
+    """
+    plans = []
+    for game in games:
+        try:
+            plans.append({'game': game, 'positions': replay_positions(game['moves'].split(), chess.Board())})
+        except Exception as e:
+            plans.append({'game': game, 'error': e})
+    plans.sort(key=lambda plan: plan['game']['moves'].split())
+
+    seen = set()
+    for plan in plans:
+        if 'error' in plan:
+            continue
+        plan['book_plies'] = count_book_plies(plan['positions'], book)
+        positions = plan['positions'] = plan['positions'][plan['book_plies']:]
+        plan['keys'] = [chess.polyglot.zobrist_hash(position) for position in positions]
+        plan['tablebase'] = [tablebase_score(position) for position in positions]
+        plan['new'] = []
+        for key, position, search in zip(plan['keys'], positions, needs_search(plan['tablebase'])):
+            if search and key not in seen:
+                seen.add(key)
+                plan['new'].append((key, position))
+    return plans
+
+def flush_stats(aggregator, player_stats_table, processed_games_table):
+    """Flushes the message's stats; returns False when a write failed and the
+    message has to be redelivered."""
+    try:
+        aggregator.flush(player_stats_table, processed_games_table)
+        return True
+    except Exception as e:
+        log_print("Error flushing stats, leaving message", aggregator.message_id, "for redelivery:", str(e),
+                  level='error')
+        return False
+
+def process_message(message, engine, player_stats_table, processed_games_table, sqs, cache=None, sink=None):
     message_id = message[0]['MessageId']
-    log_print("Processing message ID:", message_id)
+    message_started = time.perf_counter()
+    searches_before = metrics.value('analysis_engine_searches_total')
     try:
         games = json.loads(message[0]['Body'])
-        log_print("Parsed message body into games:", games)
+        log_print("Processing message", message_id, "with", len(games), "games")
     except Exception as e:
-        log_print("Error parsing message body:", str(e))
+        log_print("Error parsing message body:", str(e), level='error')
         return
-    board = chess.Board()
-    processed_games = get_processed_games(message_id, processed_games_table)
-
+    processed_games, flushed_entries, checkpoints = get_message_progress(message_id, processed_games_table)
+    if DRAIN_MODE:
+        roster = get_tracked_players(player_stats_table)
+    else:
+        roster = lookup_tracked_players({game[colour] for game in games if game['game_uuid'] not in processed_games
+                                         for colour in ('white', 'black')}, player_stats_table)
+    aggregator = StatsAggregator(message_id, flushed_entries, sink, roster=roster)
+    pending = []
+    untracked = 0
     for game in games:
         if game['game_uuid'] in processed_games:
-            log_print("Skipping already processed game:", game["game_uuid"])
+            log_print("Skipping already processed game:", game["game_uuid"], level='debug')
+            continue
+        if roster is not None and game['white'] not in roster and game['black'] not in roster:
+            untracked += 1
             continue
+        pending.append(game)
+    log_print(f"Pre-filtered {len(games) - len(pending)} of {len(games)} games, "
+              f"skipping {untracked} games with no tracked player")
 
-        board.reset()
-        moves = game['moves'].split()
-        end_time = datetime.fromtimestamp(game['end_time'], timezone.utc)
-        year = f'y{end_time.year}'
-        month = f'm{end_time.month:02}'
-        
-        log_print("Processing game:", game['game_uuid'])
+    metrics.set('analysis_message_games', len(pending))
+    metrics.set('analysis_message_games_done', 0)
+    metrics.set('analysis_message_start_time_seconds', time.time())
+    plans = plan_games(pending, opening_book)
+    # Plies scored before a previous delivery was interrupted are not searched again
+    scores = {}
+    for plan in plans:
+        if 'keys' in plan and plan['game']['game_uuid'] in checkpoints:
+            aggregator.checkpointed.add(plan['game']['game_uuid'])
+            scores.update(zip(plan['keys'], checkpoints[plan['game']['game_uuid']]))
+    for plan in plans:
+        if 'new' in plan:
+            plan['new'] = [(key, position) for key, position in plan['new'] if key not in scores]
+            step = CHECKPOINT_PLIES or len(plan['new']) or 1
+            plan['chunks'] = [plan['new'][i:i + step] for i in range(0, len(plan['new']), step)]
+    book_plies = sum(plan.get('book_plies', 0) for plan in plans)
+    total_plies = sum(len(plan['keys']) - 1 for plan in plans if 'keys' in plan)
+    unique_positions = sum(len(plan['new']) for plan in plans if 'new' in plan)
+    log_print(f"Planned {unique_positions} unique positions for {total_plies} plies across {len(plans)} games, "
+              f"skipping {book_plies} book plies and resuming {len(scores)} checkpointed positions")
+
+    # With an engine pool every game's new positions are submitted up front
+    if isinstance(engine, EnginePool):
+        for plan in plans:
+            if 'chunks' in plan:
+                plan['futures'] = [engine.submit_positions([position for _, position in chunk],
+                                                           shallow=REFINE_LIMIT is not None)
+                                   for chunk in plan['chunks']]
+
+    refined = set()
+    refined_plies = 0
+    analyzed_games = 0
+    for plan in plans:
+        if shutdown_flag:
+            # Finished games are not checkpointed, so their stats are written before stopping
+            flush_stats(aggregator, player_stats_table, processed_games_table)
+            log_print("Shutdown requested, leaving the remaining games to the next delivery.")
+            return
+        game = plan['game']
+        game_started = time.perf_counter()
+        game_searches = metrics.value('analysis_engine_searches_total')
         try:
-            game_stats = analyze_moves(moves, engine, board)
-            log_print("Analysis complete for game:", game['game_uuid'], "Stats:", game_stats)
+            if 'error' in plan:
+                raise plan['error']
+            for i, chunk in enumerate(plan['chunks']):
+                if 'futures' in plan:
+                    chunk_scores = plan['futures'][i].result()
+                else:
+                    chunk_scores = score_positions(engine, [position for _, position in chunk], cache,
+                                                   shallow=REFINE_LIMIT is not None)
+                scores.update(zip((key for key, _ in chunk), chunk_scores))
+                # The last chunk completes the game, which is then kept by its stats write
+                if CHECKPOINT_PLIES and i < len(plan['chunks']) - 1:
+                    aggregator.checkpointed.add(game['game_uuid'])
+                    analyzed = []
+                    for key in plan['keys']:
+                        if key not in scores:
+                            break
+                        analyzed.append(scores[key])
+                    save_checkpoint(message_id, game['game_uuid'], analyzed, processed_games_table)
+                    if shutdown_flag:
+                        flush_stats(aggregator, player_stats_table, processed_games_table)
+                        log_print("Shutdown requested, checkpointed game", game['game_uuid'], "and stopping.")
+                        return
+            if REFINE_LIMIT is not None:
+                refined_plies += refine_scores(plan['keys'], plan['positions'], scores, refined, engine, cache,
+                                               plan['tablebase'])
+            game_stats = classify_moves([scores.get(key) for key in plan['keys']], plan['book_plies'],
+                                        plan['tablebase'])
         except Exception as e:
-            log_print("Error analyzing game", game['game_uuid'], ":", str(e))
+            log_print("Error analyzing game", game['game_uuid'], ":", str(e), level='error')
             continue
 
-        players = {'white': game['white'], 'black': game['black']}
-        for colour, player in players.items():
-            try:
-                log_print("Fetching stats for player:", player)
-                response = player_stats_table.get_item(Key={'username': player})
-                log_print("Get_item response for", player, ":", response)
-            except Exception as e:
-                log_print("Error fetching player", player, ":", str(e))
-                continue
+        aggregator.add_game(game, game_stats)
+        record_progress()
+        metrics.inc('analysis_games_total')
+        metrics.inc('analysis_plies_total', plan['book_plies'] + len(plan['keys']) - 1)
+        metrics.inc('analysis_message_games_done')
+        metrics.observe('analysis_game_seconds', time.perf_counter() - game_started)
+        analyzed_games += 1
+        log_event('game', game_uuid=game['game_uuid'], plies=plan['book_plies'] + len(plan['keys']) - 1,
+                  book_plies=plan['book_plies'], searches=metrics.value('analysis_engine_searches_total') - game_searches,
+                  seconds=round(time.perf_counter() - game_started, 3), stats=game_stats)
+        if STATS_FLUSH_GAMES and len(aggregator.games) >= STATS_FLUSH_GAMES:
+            if not flush_stats(aggregator, player_stats_table, processed_games_table):
+                return
+
+    if not flush_stats(aggregator, player_stats_table, processed_games_table):
+        return
+    delete_message(message[0]['ReceiptHandle'], sqs)
+    metrics.inc('analysis_messages_total')
+    log_event('message', message_id=message_id, games=len(games), analyzed=analyzed_games,
+              skipped=len(games) - len(pending), plies=total_plies + book_plies, book_plies=book_plies,
+              searches=metrics.value('analysis_engine_searches_total') - searches_before,
+              refined_plies=refined_plies if REFINE_LIMIT is not None else None,
+              tablebase_hits=tablebase_hits if tablebase is not None else None,
+              cache=cache.stats() if cache is not None else None,
+              seconds=round(time.perf_counter() - message_started, 3))
+
+class StackSampler:
+    """Samples the stacks of every thread at a fixed interval.
+
+    cProfile only follows the thread that starts it, while python-chess
+    runs the UCI protocol on its own event loop thread. The samples of that
+    thread split its protocol handling from the time it waits in the
+    selector for the engine to answer.
+    """
+
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
 
-            if 'Item' not in response:
-                log_print(f"Player {player} not found in database. Skipping...")
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == self.thread.ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                self.stacks[(names.get(ident, str(ident)), *reversed(stack))] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def write_folded(self, f):
+        """Writes the samples as folded stacks, rooted at the thread name, for flame graph tools."""
+        for stack, count in sorted(self.stacks.items()):
+            f.write(";".join(stack) + f" {count}\n")
+
+    def write_summary(self, f, top):
+        """Writes each thread's top functions by own and by cumulative samples."""
+        threads = {}
+        for (thread, *frames), count in self.stacks.items():
+            own, cumulative, total = threads.setdefault(thread, (Counter(), Counter(), [0]))
+            total[0] += count
+            if frames:
+                own[frames[-1]] += count
+            for function in set(frames):
+                cumulative[function] += count
+        for thread, (own, cumulative, total) in sorted(threads.items(), key=lambda item: -item[1][2][0]):
+            f.write(f"\nThread {thread}: {total[0]} samples every {self.interval}s\n")
+            for title, counts in (("own", own), ("cumulative", cumulative)):
+                f.write(f"  By {title} samples:\n")
+                for function, count in counts.most_common(top):
+                    f.write(f"    {count:8d} {count / total[0]:6.1%}  {function}\n")
+
+def run_profiled(directory, name, function, *args, top=PROFILE_TOP):
+    """Runs the function under cProfile and writes <name>.prof and a
+    <name>.txt summary of the top functions by cumulative and own time to
+    the directory. cProfile only sees the calling thread, so every thread
+    is also sampled; the samples go to <name>.folded and a per-thread
+    summary at the end of <name>.txt."""
+    profile = cProfile.Profile()
+    sampler = StackSampler()
+    try:
+        return profile.runcall(function, *args)
+    finally:
+        sampler.stop()
+        try:
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, name)
+            profile.dump_stats(path + '.prof')
+            with open(path + '.txt', 'w') as f:
+                stats = pstats.Stats(profile, stream=f)
+                stats.sort_stats('cumulative').print_stats(top)
+                stats.sort_stats('tottime').print_stats(top)
+                f.write("Sampled stacks of every thread:\n")
+                sampler.write_summary(f, top)
+            with open(path + '.folded', 'w') as f:
+                sampler.write_folded(f)
+            log_print("Wrote profile to", path + '.prof')
+        except Exception as e:
+            log_print("Error writing profile for", name, ":", str(e), level='error')
+
+def handle_message(batch):
+    args = (batch, engine, player_stats_table, processed_games_table, sqs, eval_cache, result_sink)
+    if PROFILE_DIR:
+        return run_profiled(PROFILE_DIR, batch[0]['MessageId'], process_message, *args)
+    return process_message(*args)
+
+def run_reducer():
+    init_resources()
+    init_result_sink()
+    if result_sink is None:
+        log_print("The reducer needs STATS_SINK set to 'sqs' or 'file'.")
+        sys.exit(1)
+    try:
+        reduce_results(result_sink, player_stats_table, processed_games_table)
+    except Exception as e:
+        log_print("Error reducing results, leaving them in the sink:", str(e), level='error')
+        sys.exit(1)
+    log_print("REDUCE COMPLETE")
+    sys.exit(0)
+
+class Heartbeat:
+    """Extends the lease of the message being analyzed while analysis makes progress.
+
+    Messages are leased for VISIBILITY_TIMEOUT seconds and extended every
+    `interval`. When no progress is recorded between two beats the lease
+    is left to run out, so work from a stuck or dead worker comes back to
+    the queue within minutes. The rest of a received batch is not
+    extended, so other workers can take it once its first lease runs out,
+    but prefetched messages are, as they are taken as soon as the current
+    one is done. Nothing is extended after a shutdown signal.
+    """
+
+    def __init__(self, interval=HEARTBEAT_INTERVAL):
+        self.interval = interval
+        self.extensions = 0
+        self.failures = 0
+        self.stalls = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        progress = analysis_progress
+        while not self.stopped.wait(self.interval):
+            if analysis_progress == progress:
+                self.stalls += 1
+                log_print("No analysis progress since the last heartbeat, not extending leases.")
                 continue
+            progress = analysis_progress
+            self.beat()
 
-            current_stats = game_stats[colour]
-            game_magnitude = current_stats['blunders'] * 3 + current_stats['mistakes'] * 2 + current_stats['inaccuracies']
-            game_info = {
-                'game_url': game['game_url'],
-                'magnitude': game_magnitude,
-                'stats': current_stats
-            }
-            update_player_stats(player, current_stats, year, month, game_info, player_stats_table, 1)
-        
-        mark_game_as_processed(message_id, game['game_uuid'], processed_games_table)
-        log_print("Game processed successfully:", game['game_uuid'])
-    
-    delete_message(message[0]['ReceiptHandle'], sqs)
-    log_print("All games in message processed.")
+    def beat(self):
+        # The signal handler has already released the messages in hand
+        if shutdown_flag:
+            return
+        held = (message or [])[:1]
+        if prefetcher is not None:
+            held += prefetcher.held()
+        for queued in held:
+            if renew_lease(queued):
+                self.extensions += 1
+            else:
+                self.failures += 1
+
+    def stats(self):
+        return {'extensions': self.extensions, 'failures': self.failures, 'stalls': self.stalls}
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        log_print("Heartbeat stats:", self.stats())
+
+def drain_queue(max_messages=MAX_MESSAGES, max_runtime=MAX_RUNTIME, prefetch=PREFETCH_MESSAGES):
+    """Processes messages with the warm engine until the queue is empty, the
+    message or time budget is spent, or SIGTERM arrives.
+
+    Messages are received in batches and stay in `message` until they are
+    processed, so the signal handler releases every one still in hand. Only
+    the message being processed is kept leased; the rest of a batch is
+    leased again when it is started and skipped if another worker took it
+    in the meantime. With `prefetch` the next messages are received in the
+    background instead.
+    """
+    global message, prefetcher
+    started = time.monotonic()
+    processed = 0
+    if prefetch:
+        prefetcher = MessagePrefetcher(prefetch)
+    try:
+        while not shutdown_flag:
+            if max_messages and processed >= max_messages:
+                log_print("Message budget reached after", processed, "messages.")
+                break
+            if max_runtime and time.monotonic() - started >= max_runtime:
+                log_print("Time budget reached after", processed, "messages.")
+                break
+            if prefetcher is not None:
+                message = prefetcher.take()
+            else:
+                batch_size = RECEIVE_BATCH_SIZE
+                if max_messages:
+                    batch_size = min(batch_size, max_messages - processed)
+                fetch_message(batch_size)
+            if not message:
+                log_print("Queue drained after", processed, "messages.")
+                break
+
+            started_batch = False
+            while message and not shutdown_flag:
+                if (max_runtime and time.monotonic() - started >= max_runtime) or \
+                        (max_messages and processed >= max_messages):
+                    log_print("Budget reached, releasing", len(message), "unprocessed messages.")
+                    release_messages(message)
+                    message = []
+                    break
+                if started_batch and not renew_lease(message[0]):
+                    log_print("Lost the lease on message", message[0]['MessageId'], "- skipping it.")
+                    message.pop(0)
+                    continue
+                started_batch = True
+                handle_message(message[:1])
+                message.pop(0)
+                processed += 1
+    finally:
+        if prefetcher is not None:
+            prefetcher.release()
+            prefetcher = None
+    return processed
 
 def main():
+    global heartbeat
+    if len(sys.argv) > 1 and sys.argv[1] == 'reduce':
+        run_reducer()
+
     signal.signal(signal.SIGTERM, signal_handler)
-    init_engine()
-    init_resources()
+    if METRICS_PORT:
+        start_metrics_server()
+    # AWS clients are created while the engine boots
+    resources = threading.Thread(target=init_resources, daemon=True)
+    resources.start()
+    init_eval_cache()
+    init_tablebase()
+    init_book()
+    init_engine(cache=eval_cache)
+    resources.join()
+    init_result_sink()
+    heartbeat = Heartbeat()
 
-    while not shutdown_flag:
+    if DRAIN_MODE:
+        drain_queue()
+    elif not shutdown_flag:
         fetch_message()
         if not message:
             log_print("No messages fetched. Exiting main loop.")
-            break
-
-        process_message(message, engine, player_stats_table, processed_games_table, sqs)
+        else:
+            handle_message(message)
 
-        try:
-            engine.quit()
-            log_print("Chess engine quit successfully.")
-        except Exception as e:
-            log_print("Error quitting chess engine:", str(e))
-        log_print("TASK COMPLETE")
-        break
+    if shutdown_signal is not None:
+        released, failed = shutdown_releases
+        log_print("Shutdown signal", shutdown_signal, "received, released", released, "messages. Shutting down...",
+                  level='warning')
+        if failed:
+            log_print("Could not release messages:", ", ".join(failed), level='error')
+    heartbeat.stop()
+    try:
+        engine.quit()
+        log_print("Chess engine quit successfully.")
+    except Exception as e:
+        log_print("Error quitting chess engine:", str(e), level='error')
+    if eval_cache is not None:
+        eval_cache.close()
+    if opening_book is not None:
+        opening_book.close()
+    if tablebase is not None:
+        tablebase.close()
+    log_print("TASK COMPLETE")
 
     log_print("Exiting process now.")
     sys.exit(0)
@@ -0,0 +1,195 @@
+"""Offline throughput benchmark for the analysis worker.
+
+Feeds a versioned corpus of games in the GameImports `moves` format through
+`analyze_moves`, one game at a time, or through `process_message` as a
+single message against moto tables, using a local UCI engine. Reports
+plies/sec, engine searches per game, p50/p95 per-game latency and peak
+memory, and compares them against a stored baseline:
+
+    python tests/analysis_tests/benchmark.py --engine /usr/games/stockfish --save-baseline baseline.json
+    python tests/analysis_tests/benchmark.py --engine /usr/games/stockfish --baseline baseline.json
+
+Exits with status 1 when a metric regresses by more than the tolerance. The
+deterministic fake engine measures the worker's own overhead without
+Stockfish:
+
+    FAKE_ENGINE_LATENCY_MS=5 python tests/analysis_tests/benchmark.py --engine tests/analysis_tests/fake_uci_engine.py
+
+Timings depend on the machine, so the committed baseline only holds the
+metrics that do not. The tests compare the fake engine's message mode
+against it; after an intended change it is rewritten with:
+
+    python tests/analysis_tests/benchmark.py --engine tests/analysis_tests/fake_uci_engine.py --mode message \
+        --save-baseline tests/analysis_tests/baselines/fake-engine-message.json --portable
+"""
+import argparse
+import json
+import os
+import resource
+import sys
+import time
+
+import boto3
+import chess
+import chess.engine
+from moto import mock_aws
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.append(ROOT)
+sys.path.append(os.path.join(ROOT, 'container', 'chess-analysis', 'eks'))
+
+import analysis
+from tests.analysis_tests.dynamodb_transactions import cancel_like_dynamodb
+
+DEFAULT_CORPUS = os.path.join(os.path.dirname(__file__), 'corpus', 'games-v1.json')
+FAKE_ENGINE_BASELINE = os.path.join(os.path.dirname(__file__), 'baselines', 'fake-engine-message.json')
+# Metrics compared against the baseline, and whether higher values are better
+COMPARED_METRICS = {
+    'plies_per_second': True,
+    'searches_per_game': False,
+    'p50_game_seconds': False,
+    'p95_game_seconds': False,
+    'peak_rss_mb': False,
+}
+# Metrics that are the same on every machine for a given engine and corpus
+PORTABLE_METRICS = ['corpus_version', 'mode', 'games', 'plies', 'searches_per_game']
+
+def load_corpus(path=DEFAULT_CORPUS):
+    with open(path) as f:
+        return json.load(f)
+
+def percentile(values, fraction):
+    if not values:
+        return 0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+def bench_moves(games, engine):
+    """Analyzes every game on its own and returns the per-game latencies."""
+    latencies = []
+    for game in games:
+        started = time.perf_counter()
+        analysis.analyze_moves(game['moves'].split(), engine, chess.Board(), analysis.eval_cache)
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+def bench_message(games, engine):
+    """Processes the corpus as one message against moto tables and returns
+    the per-game latencies reported in the worker's game events."""
+    latencies = []
+    log_event = analysis.log_event
+
+    def capture(event, level='info', sampled=False, **fields):
+        if event == 'game':
+            latencies.append(fields['seconds'])
+        log_event(event, level, sampled, **fields)
+
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+    with mock_aws():
+        dynamodb = boto3.resource('dynamodb', region_name='us-east-1')
+        cancel_like_dynamodb(dynamodb.meta.client)
+        tables = {}
+        for name, key in [('PlayerStats', 'username'), ('ProcessedGames', 'message_id')]:
+            tables[name] = dynamodb.create_table(
+                TableName=name,
+                KeySchema=[{'AttributeName': key, 'KeyType': 'HASH'}],
+                AttributeDefinitions=[{'AttributeName': key, 'AttributeType': 'S'}],
+                BillingMode='PAY_PER_REQUEST'
+            )
+        for player in {game[colour] for game in games for colour in ('white', 'black')}:
+            tables['PlayerStats'].put_item(Item={'username': player})
+        sqs = boto3.client('sqs', region_name='us-east-1')
+        queue_url = sqs.create_queue(QueueName='benchmark')['QueueUrl']
+        sqs.send_message(QueueUrl=queue_url, MessageBody=json.dumps(games))
+        message = sqs.receive_message(QueueUrl=queue_url)['Messages']
+
+        analysis.log_event = capture
+        analysis.QUEUE_URL, queue_url = queue_url, analysis.QUEUE_URL
+        try:
+            analysis.process_message(message, engine, tables['PlayerStats'], tables['ProcessedGames'], sqs,
+                                     analysis.eval_cache)
+        finally:
+            analysis.log_event = log_event
+            analysis.QUEUE_URL = queue_url
+    return latencies
+
+def run_benchmark(corpus, engine, mode='moves'):
+    games = corpus['games']
+    plies = sum(len(game['moves'].split()) for game in games)
+    searches = analysis.metrics.value('analysis_engine_searches_total')
+    started = time.perf_counter()
+    latencies = bench_moves(games, engine) if mode == 'moves' else bench_message(games, engine)
+    seconds = time.perf_counter() - started
+    searches = analysis.metrics.value('analysis_engine_searches_total') - searches
+    return {
+        'corpus_version': corpus['version'],
+        'mode': mode,
+        'games': len(games),
+        'plies': plies,
+        'seconds': round(seconds, 3),
+        'plies_per_second': round(plies / seconds, 2) if seconds else 0,
+        'searches_per_game': round(searches / len(games), 2) if games else 0,
+        'p50_game_seconds': round(percentile(latencies, 0.5), 4),
+        'p95_game_seconds': round(percentile(latencies, 0.95), 4),
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+def compare_to_baseline(report, baseline, tolerance=0.1):
+    """Returns a description of every compared metric that is worse than the
+    baseline by more than the tolerance."""
+    if baseline.get('corpus_version') != report['corpus_version'] or baseline.get('mode') != report['mode']:
+        return [f"baseline is for corpus v{baseline.get('corpus_version')} in {baseline.get('mode')} mode, "
+                f"not v{report['corpus_version']} in {report['mode']} mode"]
+    regressions = []
+    for metric, higher_is_better in COMPARED_METRICS.items():
+        expected, actual = baseline.get(metric), report[metric]
+        if not expected:
+            continue
+        change = (actual - expected) / expected
+        if (-change if higher_is_better else change) > tolerance:
+            regressions.append(f"{metric}: {actual} vs baseline {expected} ({change:+.1%})")
+    return regressions
+
+def portable(report):
+    """Returns the report's machine-independent metrics, for a committed baseline."""
+    return {metric: report[metric] for metric in PORTABLE_METRICS}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--corpus', default=DEFAULT_CORPUS)
+    parser.add_argument('--engine', default=analysis.ENGINE_PATH or analysis.DEFAULT_ENGINE_PATH)
+    parser.add_argument('--mode', choices=['moves', 'message'], default='moves')
+    parser.add_argument('--baseline', help='baseline JSON to compare against')
+    parser.add_argument('--save-baseline', help='write the report to this path as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    parser.add_argument('--portable', action='store_true', help='save only the machine-independent metrics')
+    args = parser.parse_args()
+
+    analysis.event_log.level = analysis.LOG_LEVELS['warning']
+    corpus = load_corpus(args.corpus)
+    engine = chess.engine.SimpleEngine.popen_uci(args.engine)
+    try:
+        if analysis.engine_options():
+            engine.configure(analysis.engine_options())
+        report = run_benchmark(corpus, engine, args.mode)
+    finally:
+        engine.quit()
+    report['engine'] = args.engine
+    print(json.dumps(report, indent=2))
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(portable(report) if args.portable else report, f, indent=2)
+            f.write("\n")
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare_to_baseline(report, json.load(f), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION", regression)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+"""Makes moto cancel transactions the way DynamoDB does.
+
+DynamoDB cancels a TransactWriteItems call with a reason per item: a
+ValidationError for an update that adds to a yearly or monthly map that
+does not exist yet, and ConditionalCheckFailed for a player that is not
+tracked. moto rejects the whole call with a ValidationException instead.
+"""
+import re
+
+from botocore.exceptions import ClientError
+
+PERIOD_PATH = re.compile(r'game_stats\.(y\d+)(?:\.(m\d+))?')
+
+def cancellation_reason(client, item):
+    update = item.get('Update', {})
+    periods = PERIOD_PATH.findall(update.get('UpdateExpression', ''))
+    if not periods:
+        return 'None'
+    stored = client.get_item(TableName=update['TableName'], Key=update['Key']).get('Item')
+    if stored is None:
+        return 'ConditionalCheckFailed'
+    game_stats = stored.get('game_stats', {})
+    for year, month in periods:
+        if year not in game_stats or (month and month not in game_stats[year]):
+            return 'ValidationError'
+    return 'None'
+
+def cancel_like_dynamodb(client):
+    """Wraps the client's transact_write_items so moto's ValidationException
+    comes back as a TransactionCanceledException with per-item reasons."""
+    transact_write_items = client.transact_write_items
+
+    def aws_transact_write_items(TransactItems, **kwargs):
+        try:
+            return transact_write_items(TransactItems=TransactItems, **kwargs)
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ValidationException':
+                raise
+            reasons = [{'Code': cancellation_reason(client, item)} for item in TransactItems]
+            raise ClientError({'Error': {'Code': 'TransactionCanceledException', 'Message': 'Transaction cancelled'},
+                               'CancellationReasons': reasons}, 'TransactWriteItems') from e
+
+    client.transact_write_items = aws_transact_write_items
+    return client
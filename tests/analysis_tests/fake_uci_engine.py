@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""A deterministic UCI engine for testing and benchmarking the worker without Stockfish.
+
+Scores are the material balance plus a small jitter derived from the
+position's Zobrist hash, so every run returns the same evaluation for the
+same position. Checkmates score mate 0 and a mate in one is always found,
+which is enough for blunders such as walking into a mate to register.
+
+Each search sleeps for an artificial latency, set in milliseconds with the
+FAKE_ENGINE_LATENCY_MS environment variable, the --latency argument or the
+Latency UCI option, and reports nodes and nps as if it had searched for
+that long. Launch it with chess.engine.SimpleEngine.popen_uci or point
+ENGINE_PATH at this file.
+"""
+import os
+import sys
+import time
+
+import chess
+import chess.polyglot
+
+PIECE_VALUES = {chess.PAWN: 100, chess.KNIGHT: 300, chess.BISHOP: 300, chess.ROOK: 500, chess.QUEEN: 900}
+DEFAULT_DEPTH = 20
+NODES_PER_SECOND = 1_000_000
+
+def material(board):
+    """Returns the material balance from the side to move's point of view."""
+    balance = sum(value * (len(board.pieces(piece, chess.WHITE)) - len(board.pieces(piece, chess.BLACK)))
+                  for piece, value in PIECE_VALUES.items())
+    return balance if board.turn == chess.WHITE else -balance
+
+def mate_in_one(board):
+    for move in board.legal_moves:
+        board.push(move)
+        mate = board.is_checkmate()
+        board.pop()
+        if mate:
+            return move
+    return None
+
+def search(board):
+    """Returns the UCI score and best move for the side to move."""
+    if board.is_checkmate():
+        return "mate 0", None
+    move = mate_in_one(board)
+    if move is not None:
+        return "mate 1", move
+    jitter = chess.polyglot.zobrist_hash(board) % 21 - 10
+    return f"cp {material(board) + jitter}", next(iter(board.legal_moves), None)
+
+def parse_position(tokens):
+    if tokens[0] == 'startpos':
+        board = chess.Board()
+        tokens = tokens[1:]
+    else:
+        end = tokens.index('moves') if 'moves' in tokens else len(tokens)
+        board = chess.Board(" ".join(tokens[1:end]))
+        tokens = tokens[end:]
+    for move in tokens[1:]:
+        board.push_uci(move)
+    return board
+
+def send(line):
+    sys.stdout.write(line + "\n")
+    sys.stdout.flush()
+
+def main(argv):
+    latency = float(os.getenv('FAKE_ENGINE_LATENCY_MS', '0'))
+    if '--latency' in argv:
+        latency = float(argv[argv.index('--latency') + 1])
+    board = chess.Board()
+
+    for line in sys.stdin:
+        tokens = line.split()
+        if not tokens:
+            continue
+        command = tokens[0]
+        if command == 'uci':
+            send("id name FakeUCIEngine")
+            send("option name Threads type spin default 1 min 1 max 512")
+            send("option name Hash type spin default 16 min 1 max 33554432")
+            send("option name Latency type spin default 0 min 0 max 600000")
+            send("uciok")
+        elif command == 'isready':
+            send("readyok")
+        elif command == 'setoption' and 'name' in tokens and 'value' in tokens:
+            name = " ".join(tokens[tokens.index('name') + 1:tokens.index('value')])
+            if name.lower() == 'latency':
+                latency = float(tokens[tokens.index('value') + 1])
+        elif command == 'position':
+            board = parse_position(tokens[1:])
+        elif command == 'go':
+            depth = int(tokens[tokens.index('depth') + 1]) if 'depth' in tokens else DEFAULT_DEPTH
+            if latency:
+                time.sleep(latency / 1000)
+            score, move = search(board)
+            nodes = max(1, int(NODES_PER_SECOND * latency / 1000))
+            nps = int(nodes * 1000 / latency) if latency else NODES_PER_SECOND
+            pv = f" pv {move.uci()}" if move else ""
+            send(f"info depth {depth} nodes {nodes} nps {nps} time {int(latency)} score {score}{pv}")
+            send(f"bestmove {move.uci() if move else '(none)'}")
+        elif command == 'quit':
+            break
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
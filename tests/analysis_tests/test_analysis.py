@@ -2,24 +2,42 @@ import pytest
 import boto3
 import chess
 import chess.engine
+import chess.polyglot
+import chess.syzygy
 from moto import mock_aws
+from botocore.exceptions import ClientError
 from datetime import datetime
 import os
 import json
+import urllib.request
+import time
+import threading
+import hashlib
 import sys
+import struct
 
-sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'container', 'chess-analysis', 'eks')))
 
-from container.analysis import process_message, update_player_stats, analyze_moves
+import analysis
+from tests.analysis_tests import benchmark
+from tests.analysis_tests.dynamodb_transactions import cancel_like_dynamodb
+from analysis import process_message, analyze_moves, EnginePool, EvalCache, SEARCH_LIMIT, shard_positions, search_limit
 
-@pytest.fixture(scope="module")
-def chess_engine():
+FAKE_ENGINE_PATH = os.path.join(os.path.dirname(__file__), 'fake_uci_engine.py')
+
+def engine_path():
+    # ENGINE_PATH may point at any UCI engine, the fake one included. Without
+    # Stockfish the tests fall back to the fake engine
+    if os.getenv('ENGINE_PATH'):
+        return os.getenv('ENGINE_PATH')
     if os.getenv('CI', 'false').lower() == 'true':
-        path = '/usr/games/stockfish'
-    else:
-        path = 'analysis_tests/stockfish/stockfish-windows-x86-64-avx2.exe'
+        return '/usr/games/stockfish'
+    path = 'analysis_tests/stockfish/stockfish-windows-x86-64-avx2.exe'
+    return path if os.path.exists(path) else FAKE_ENGINE_PATH
 
-    engine = chess.engine.SimpleEngine.popen_uci(path)
+@pytest.fixture(scope="module")
+def chess_engine():
+    engine = chess.engine.SimpleEngine.popen_uci(engine_path())
     yield engine
 
     engine.quit()
@@ -36,6 +54,7 @@ def aws_credentials():
 def dynamodb(aws_credentials):
     with mock_aws():
         dynamodb = boto3.resource('dynamodb', region_name='us-east-1')
+        cancel_like_dynamodb(dynamodb.meta.client)
         yield dynamodb
 
 @pytest.fixture(scope="function")
@@ -69,29 +88,20 @@ def queue(sqs):
     queue = sqs.create_queue(QueueName='TestQueue')
     yield queue['QueueUrl']
 
-def test_update_player_stats(dynamodb_table):
-    player = "test_player"
-    stats = {"inaccuracies": 2, "mistakes": 1, "blunders": 0}
-    year = "y2024"
-    month = "m01"
-    game_info = {
-        "url": "https://lichess.org/test_game",
-        "magnitude": 4,
-        "stats": stats
-    }
-
-    update_player_stats(player, stats, year, month, game_info, dynamodb_table, 1)
-
-    response = dynamodb_table.get_item(Key={'username': player})
-    assert 'Item' in response
-    player_data = response['Item']
-
-    assert player_data['game_stats'][year]['player_total'] == stats
-    assert player_data['game_stats'][year][month]['player_total'] == stats
-    assert player_data['game_stats'][year]['total_games'] == 1
-    assert player_data['game_stats'][year][month]['total_games'] == 1
-    assert player_data['game_stats'][year]['worst_game'] == game_info
-    assert player_data['game_stats'][year][month]['worst_game'] == game_info
+class CountingTable:
+    def __init__(self, table):
+        self.table = table
+        self.calls = []
+
+    def __getattr__(self, name):
+        attribute = getattr(self.table, name)
+        if not callable(attribute):
+            return attribute
+
+        def call(*args, **kwargs):
+            self.calls.append(name)
+            return attribute(*args, **kwargs)
+        return call
 
 def test_analyze_moves(chess_engine):
     board = chess.Board()
@@ -101,6 +111,932 @@ def test_analyze_moves(chess_engine):
 
     assert stats['white']['blunders'] == 0
     assert stats['black']['blunders'] >= 1  # The final move should be considered a blunder
+
+class CountingEngine:
+    def __init__(self):
+        self.fens = []
+
+    def analyse(self, board, limit):
+        self.fens.append(board.fen())
+        cp = chess.polyglot.zobrist_hash(board) % 601 - 300
+        return {'score': chess.engine.PovScore(chess.engine.Cp(cp), board.turn)}
+
+def count_transactions(table):
+    transactions = []
+    table.meta.client.meta.events.register(
+        'before-call.dynamodb.TransactWriteItems', lambda **kwargs: transactions.append(1))
+    return transactions
+
+def test_analyze_moves_searches_each_position_once():
+    engine = CountingEngine()
+    moves = ["e4", "e5", "Nf3", "Nc6"]
+
+    analyze_moves(moves, engine, chess.Board())
+
+    assert len(engine.fens) == len(moves) + 1
+    assert len(set(engine.fens)) == len(engine.fens)
+
+class FixedScoreEngine:
+    def __init__(self, cp):
+        self.cp = cp
+        self.limits = []
+
+    def analyse(self, board, limit):
+        self.limits.append(limit)
+        return {'score': chess.engine.PovScore(chess.engine.Cp(self.cp), chess.WHITE)}
+
+def test_search_limit_from_config():
+    assert search_limit() == chess.engine.Limit(depth=20)
+    assert search_limit(depth='18') == chess.engine.Limit(depth=18)
+    assert search_limit(nodes='500000', movetime='250') == chess.engine.Limit(nodes=500000, time=0.25)
+
+def test_analyze_moves_skips_search_of_checkmate():
+    engine = CountingEngine()
+    moves = ["e4", "e5", "Qh5", "Nc6", "Bc4", "Nf6", "Qxf7#"]
+
+    stats = analyze_moves(moves, engine, chess.Board())
+
+    assert len(engine.fens) == len(moves)
+    assert stats['black']['blunders'] + stats['black']['mistakes'] + stats['black']['inaccuracies'] >= 1
+
+def test_decisive_positions_keep_shallow_score(monkeypatch):
+    shallow = chess.engine.Limit(depth=8)
+    monkeypatch.setattr(analysis, 'DECISIVE_LIMIT', shallow)
+    moves = ["e4", "e5", "Nf3"]
+
+    decided = FixedScoreEngine(2000)
+    analyze_moves(moves, decided, chess.Board())
+    assert decided.limits == [shallow] * (len(moves) + 1)
+
+    balanced = FixedScoreEngine(30)
+    analyze_moves(moves, balanced, chess.Board())
+    assert balanced.limits == [shallow, SEARCH_LIMIT] * (len(moves) + 1)
+
+def test_refinement_only_re_searches_plies_near_cutoffs(monkeypatch):
+    shallow = chess.engine.Limit(depth=10)
+    monkeypatch.setattr(analysis, 'REFINE_LIMIT', shallow)
+    scores = {shallow.depth: [0, 0, 200, 200], SEARCH_LIMIT.depth: [0, 0, 300, 200]}
+
+    class ScriptedEngine:
+        def __init__(self):
+            self.searches = []
+
+        def analyse(self, board, limit):
+            ply = len(board.move_stack)
+            self.searches.append((ply, limit))
+            return {'score': chess.engine.PovScore(chess.engine.Cp(scores[limit.depth][ply]), chess.WHITE)}
+
+    engine = ScriptedEngine()
+
+    stats = analyze_moves(["e4", "e5", "Nf3"], engine, chess.Board())
+
+    # The second ply lands near the blunder cutoff (0.176 against 0.2). Its
+    # full-depth score then puts the third ply near the inaccuracy cutoff
+    full_searches = [ply for ply, limit in engine.searches if limit == SEARCH_LIMIT]
+    assert full_searches == [1, 2, 3]
+    assert stats['black'] == {'inaccuracies': 0, 'mistakes': 0, 'blunders': 1}
+    assert stats['white'] == {'inaccuracies': 1, 'mistakes': 0, 'blunders': 0}
+
+def test_tablebase_positions_skip_engine(monkeypatch):
+    class FakeTablebase:
+        def probe_wdl(self, board):
+            if chess.popcount(board.occupied) > 3:
+                raise chess.syzygy.MissingTableError("not in tablebase")
+            return 2 if board.turn == chess.WHITE else -2
+
+        def probe_dtz(self, board):
+            return 10 if board.turn == chess.WHITE else -9
+
+    monkeypatch.setattr(analysis, 'tablebase', FakeTablebase())
+    board = chess.Board("8/8/8/4k3/8/8/3QK3/8 w - - 0 1")
+    engine = CountingEngine()
+
+    stats = analyze_moves(["Qd3", "Kf4", "Qe3+"], engine, board)
+
+    assert engine.fens == []
+    assert stats['white'] == {'inaccuracies': 0, 'mistakes': 0, 'blunders': 0}
+    assert analysis.tablebase_score(chess.Board("8/8/8/4k3/8/8/3QK3/8 b - - 0 1")) == analysis.TABLEBASE_WIN_SCORE - 9
+    assert analysis.tablebase_score(chess.Board()) is None
+
+def test_tablebase_scores_only_compared_with_each_other(monkeypatch):
+    class DrawnTablebase:
+        def probe_wdl(self, board):
+            if chess.popcount(board.occupied) > 3:
+                raise chess.syzygy.MissingTableError("not in tablebase")
+            return 0
+
+    monkeypatch.setattr(analysis, 'tablebase', DrawnTablebase())
+    board = chess.Board("8/8/8/4k3/8/3p4/3RK3/8 w - - 0 1")
+    engine = FixedScoreEngine(250)
+
+    # Rxd3 enters a drawn tablebase position from an engine score of +250
+    stats = analyze_moves(["Rxd3", "Ke4", "Rd8"], engine, board)
+
+    # The entering position is also searched, so the capture is measured on engine scores alone
+    assert len(engine.limits) == 2
+    assert stats['white'] == {'inaccuracies': 0, 'mistakes': 0, 'blunders': 0}
+
+def write_polyglot_book(path, lines):
+    entries = []
+    for line in lines:
+        board = chess.Board()
+        for san in line:
+            move = board.parse_san(san)
+            encoded = move.to_square | (move.from_square << 6)
+            entries.append(struct.pack(">QHHI", chess.polyglot.zobrist_hash(board), encoded, 1, 0))
+            board.push(move)
+    with open(path, 'wb') as f:
+        f.write(b''.join(sorted(set(entries))))
+
+def test_book_plies_skip_engine(tmp_path, monkeypatch):
+    path = str(tmp_path / 'book.bin')
+    write_polyglot_book(path, [["e4", "e5", "Nf3"]])
+    book = chess.polyglot.open_reader(path)
+    monkeypatch.setattr(analysis, 'opening_book', book)
+    engine = CountingEngine()
+    moves = ["e4", "e5", "Nf3", "Nc6", "Bb5"]
+
+    analyze_moves(moves, engine, chess.Board())
+
+    # The first out-of-book position, after 2. Nf3, is still searched
+    assert len(engine.fens) == 3
+    assert engine.fens[0] == "rnbqkbnr/pppp1ppp/8/4p3/4P3/5N2/PPPP1PPP/RNBQKB1R b KQkq - 1 2"
+
+    positions = analysis.replay_positions(moves, chess.Board())
+    assert analysis.count_book_plies(positions, book) == 3
+    assert analysis.count_book_plies(positions, None) == 0
+    book.close()
+
+def test_init_book_loads_the_bundled_book_when_present(tmp_path, monkeypatch):
+    monkeypatch.setattr(analysis, 'opening_book', None)
+    path = str(tmp_path / 'book.bin')
+
+    # An image built without BOOK_URL has no book at BOOK_PATH
+    analysis.init_book(path)
+    assert analysis.opening_book is None
+
+    write_polyglot_book(path, [["e4", "e5"]])
+    analysis.init_book(path)
+    assert analysis.opening_book is not None
+    analysis.opening_book.close()
+
+def test_cpu_features(tmp_path):
+    cpuinfo = tmp_path / 'cpuinfo'
+    cpuinfo.write_text("processor\t: 0\nFeatures\t: fp asimd evtstrm aes asimddp\n")
+
+    assert analysis.cpu_features(str(cpuinfo)) == {'fp', 'asimd', 'evtstrm', 'aes', 'asimddp'}
+    assert analysis.cpu_features(str(tmp_path / 'missing')) == set()
+
+def test_select_engine_path_benchmarks_supported_builds(tmp_path, monkeypatch):
+    for build in ['stockfish-android-armv8', 'stockfish-android-armv8-dotprod', 'stockfish-ubuntu-x86-64-avx2']:
+        (tmp_path / build).write_text('')
+    nps = {'stockfish-android-armv8': 900000, 'stockfish-android-armv8-dotprod': 1400000}
+    benched = []
+
+    def fake_bench(path):
+        benched.append(os.path.basename(path))
+        return nps[os.path.basename(path)]
+
+    monkeypatch.setattr(analysis, 'bench_engine', fake_bench)
+
+    path = analysis.select_engine_path(str(tmp_path), {'asimd', 'asimddp'})
+
+    assert os.path.basename(path) == 'stockfish-android-armv8-dotprod'
+    assert sorted(benched) == ['stockfish-android-armv8', 'stockfish-android-armv8-dotprod']
+    assert analysis.select_engine_path(str(tmp_path / 'missing'), set()) == analysis.DEFAULT_ENGINE_PATH
+
+def test_analyze_moves_uses_eval_cache():
+    engine = CountingEngine()
+    cache = EvalCache(size=100)
+    moves = ["e4", "e5", "Nf3", "Nc6"]
+
+    first = analyze_moves(moves, engine, chess.Board(), cache)
+    second = analyze_moves(moves, engine, chess.Board(), cache)
+
+    assert first == second
+    assert len(engine.fens) == len(moves) + 1
+    assert cache.stats() == {'hits': len(moves) + 1, 'disk_hits': 0, 'misses': len(moves) + 1}
+
+def test_process_message_deduplicates_positions(dynamodb_table, processed_games_table, sqs):
+    players = ['player1', 'player2']
+    for player in players:
+        dynamodb_table.put_item(Item={'username': player})
+
+    games = [
+        {"game_uuid": "game-1", "white": "player1", "black": "player2",
+         "moves": "e4 e5 Nf3 Nc6 Bb5", "end_time": 1718452800, "game_url": "https://www.chess.com/game/live/1"},
+        {"game_uuid": "game-2", "white": "player2", "black": "player1",
+         "moves": "e4 e5 Nf3 Nc6 Bc4", "end_time": 1718452800, "game_url": "https://www.chess.com/game/live/2"},
+        {"game_uuid": "game-3", "white": "player1", "black": "player2",
+         "moves": "Nf3 Nc6 e4 e5 Bb5", "end_time": 1718452800, "game_url": "https://www.chess.com/game/live/3"},
+    ]
+    message = [{'MessageId': 'test-message-id', 'Body': json.dumps(games), 'ReceiptHandle': 'test-receipt-handle'}]
+    engine = CountingEngine()
+
+    process_message(message, engine, dynamodb_table, processed_games_table, sqs)
+
+    # Six Ruy Lopez positions, the Italian, and three Nf3 move-order positions
+    # before it transposes back into the Ruy Lopez
+    assert len(engine.fens) == 10
+    processed = processed_games_table.get_item(Key={'message_id': 'test-message-id'})['Item']
+    assert processed['processed_game_ids'] == {'game-1', 'game-2', 'game-3'}
+
+    expected = {'inaccuracies': 0, 'mistakes': 0, 'blunders': 0}
+    for game in games:
+        stats = analyze_moves(game['moves'].split(), CountingEngine(), chess.Board())
+        for stat in expected:
+            expected[stat] += stats['white'][stat] if game['white'] == 'player1' else stats['black'][stat]
+    player_data = dynamodb_table.get_item(Key={'username': 'player1'})['Item']
+    assert player_data['game_stats']['y2024']['player_total'] == expected
+    assert player_data['game_stats']['y2024']['total_games'] == 3
+
+def test_process_message_aggregates_player_stats(dynamodb_table, processed_games_table, sqs):
+    period = {'total_games': 0, 'player_total': {}, 'worst_game': {}}
+    for player in ['player1', 'player2']:
+        dynamodb_table.put_item(Item={'username': player, 'game_stats': {'y2024': dict(period, m06=period)}})
+    games = [
+        {"game_uuid": f"game-{i}", "white": "player1", "black": "player2", "moves": moves,
+         "end_time": 1718452800, "game_url": f"https://www.chess.com/game/live/{i}"}
+        for i, moves in enumerate(["e4 e5 Qh5 Nc6 Bc4 Nf6 Qxf7#", "d4 d5 c4 e6"])
+    ]
+    message = [{'MessageId': 'test-message-id', 'Body': json.dumps(games), 'ReceiptHandle': 'test-receipt-handle'}]
+    table = CountingTable(dynamodb_table)
+    transactions = count_transactions(dynamodb_table)
+
+    process_message(message, CountingEngine(), table, processed_games_table, sqs)
+
+    # One transaction for both players' counters, then two worst game writes per player
+    assert transactions == [1]
+    assert table.calls == ['update_item'] * 4
+    for player in ['player1', 'player2']:
+        game_stats = dynamodb_table.get_item(Key={'username': player})['Item']['game_stats']
+        assert game_stats['y2024']['m06']['total_games'] == 2
+
+def test_batch_without_tracked_players_is_still_marked_processed(dynamodb_table, processed_games_table):
+    game = {"game_uuid": "game-1", "white": "stranger1", "black": "stranger2",
+            "end_time": 1718452800, "game_url": "https://www.chess.com/game/live/1"}
+    game_stats = {colour: {'inaccuracies': 1, 'mistakes': 0, 'blunders': 0} for colour in ['white', 'black']}
+    aggregator = analysis.StatsAggregator('test-message-id', roster={'player1'})
+
+    aggregator.add_game(game, game_stats)
+    aggregator.flush(dynamodb_table, processed_games_table)
+
+    processed = processed_games_table.get_item(Key={'message_id': 'test-message-id'})['Item']
+    assert processed['processed_game_ids'] == {'game-1'}
+    assert 'Item' not in dynamodb_table.get_item(Key={'username': 'stranger1'})
+
+def test_stats_batches_are_written_exactly_once(dynamodb_table, processed_games_table, sqs):
+    for player in ['player1', 'player2']:
+        dynamodb_table.put_item(Item={'username': player})
+    game = {"game_uuid": "game-1", "white": "player1", "black": "player2",
+            "end_time": 1718452800, "game_url": "https://www.chess.com/game/live/1"}
+    game_stats = {colour: {'inaccuracies': 1, 'mistakes': 0, 'blunders': 0} for colour in ['white', 'black']}
+
+    # Two deliveries of the same message flush the same batch, neither having seen the other's marker
+    for _ in range(2):
+        aggregator = analysis.StatsAggregator('test-message-id')
+        aggregator.add_game(game, game_stats)
+        aggregator.flush(dynamodb_table, processed_games_table)
+
+    game_stats = dynamodb_table.get_item(Key={'username': 'player1'})['Item']['game_stats']
+    assert game_stats['y2024']['total_games'] == 1
+    assert game_stats['y2024']['m06']['player_total']['inaccuracies'] == 1
+    assert game_stats['y2024']['m06']['worst_game']['game_url'] == game['game_url']
+    processed = processed_games_table.get_item(Key={'message_id': 'test-message-id'})['Item']
+    assert processed['processed_game_ids'] == {'game-1'}
+
+def cancelled_transaction(reasons):
+    return ClientError({'Error': {'Code': 'TransactionCanceledException', 'Message': 'Transaction cancelled'},
+                        'CancellationReasons': [{'Code': reason} for reason in reasons]}, 'TransactWriteItems')
+
+def test_stats_transaction_creates_maps_cancelled_by_dynamodb(dynamodb_table, processed_games_table):
+    period = {'total_games': 0, 'player_total': {}, 'worst_game': {}}
+    dynamodb_table.put_item(Item={'username': 'player1', 'game_stats': {'y2024': dict(period, m06=period)}})
+    dynamodb_table.put_item(Item={'username': 'player2'})
+    transactions = count_transactions(dynamodb_table)
+    game = {"game_uuid": "game-1", "white": "player1", "black": "player2",
+            "end_time": 1718452800, "game_url": "https://www.chess.com/game/live/1"}
+    aggregator = analysis.StatsAggregator('test-message-id')
+    aggregator.add_game(game, {colour: {'inaccuracies': 1, 'mistakes': 0, 'blunders': 0} for colour in ['white', 'black']})
+
+    aggregator.flush(dynamodb_table, processed_games_table)
+
+    # DynamoDB cancels player2's update for its missing maps, which are created before the retry
+    assert transactions == [1, 1]
+    for player in ['player1', 'player2']:
+        game_stats = dynamodb_table.get_item(Key={'username': player})['Item']['game_stats']
+        assert game_stats['y2024']['m06']['total_games'] == 1
+        assert game_stats['y2024']['m06']['player_total']['inaccuracies'] == 1
+
+def test_failed_stats_transaction_leaves_message_for_redelivery(dynamodb_table, processed_games_table, sqs, monkeypatch):
+    for player in ['player1', 'player2']:
+        dynamodb_table.put_item(Item={'username': player})
+    games = [{"game_uuid": "game-1", "white": "player1", "black": "player2", "moves": "e4 e5 Nf3",
+              "end_time": 1718452800, "game_url": "https://www.chess.com/game/live/1"}]
+    message = [{'MessageId': 'test-message-id', 'Body': json.dumps(games), 'ReceiptHandle': 'test-receipt-handle'}]
+    deleted = []
+    monkeypatch.setattr(analysis, 'delete_message', lambda receipt_handle, sqs: deleted.append(receipt_handle))
+
+    def throttled(TransactItems):
+        raise cancelled_transaction(['ThrottlingError'] * len(TransactItems))
+
+    monkeypatch.setattr(dynamodb_table.meta.client, 'transact_write_items', throttled)
+    process_message(message, CountingEngine(), dynamodb_table, processed_games_table, sqs)
+
+    assert deleted == []
+    assert 'Item' not in processed_games_table.get_item(Key={'message_id': 'test-message-id'})
+
+def test_processed_games_read_legacy_list(processed_games_table):
+    processed_games_table.put_item(Item={'message_id': 'test-message-id', 'game_ids': ['game-1']})
+    analysis.mark_games_as_processed('test-message-id', ['game-2'], processed_games_table)
+
+    assert analysis.get_processed_games('test-message-id', processed_games_table) == {'game-1', 'game-2'}
+
+def test_reducer_merges_results_from_workers(dynamodb_table, processed_games_table, sqs, tmp_path):
+    period = {'total_games': 0, 'player_total': {}, 'worst_game': {}}
+    for player in ['player1', 'player2']:
+        dynamodb_table.put_item(Item={'username': player, 'game_stats': {'y2024': dict(period, m06=period)}})
+    sink = analysis.FileResultSink(str(tmp_path / 'results'))
+    for i, moves in enumerate(["e4 e5 Qh5 Nc6 Bc4 Nf6 Qxf7#", "d4 d5 c4 e6"]):
+        games = [{"game_uuid": f"game-{i}", "white": "player1", "black": "player2", "moves": moves,
+                  "end_time": 1718452800, "game_url": f"https://www.chess.com/game/live/{i}"}]
+        message = [{'MessageId': f'message-{i}', 'Body': json.dumps(games), 'ReceiptHandle': 'test-receipt-handle'}]
+        process_message(message, CountingEngine(), dynamodb_table, processed_games_table, sqs, sink=sink)
+    # A redelivered worker message emits the same game again
+    sink.emit(sink.read()[0][0])
+    assert dynamodb_table.get_item(Key={'username': 'player1'})['Item']['game_stats']['y2024']['m06']['total_games'] == 0
+    table = CountingTable(dynamodb_table)
+    transactions = count_transactions(dynamodb_table)
+
+    assert analysis.reduce_results(sink, table, processed_games_table) == 2
+
+    # One counter transaction, plus the worst game year and month writes per player
+    assert transactions == [1]
+    assert table.calls.count('update_item') == 4
+    for player in ['player1', 'player2']:
+        game_stats = dynamodb_table.get_item(Key={'username': player})['Item']['game_stats']
+        assert game_stats['y2024']['m06']['total_games'] == 2
+    assert sink.read() == []
+    # The run's item holds the games it claimed and its chunk markers, not processed game ids
+    runs = [item for item in processed_games_table.scan()['Items']
+            if item['message_id'].startswith('stats-reducer#') and not item['message_id'].startswith('stats-reducer#game#')]
+    assert len(runs) == 1 and runs[0]['complete'] and 'processed_game_ids' not in runs[0]
+    assert runs[0]['game_uuids'] == {'game-0', 'game-1'}
+
+def test_reducer_counts_each_game_once_across_runs(dynamodb_table, processed_games_table, monkeypatch):
+    for player in ['player1', 'player2']:
+        dynamodb_table.put_item(Item={'username': player})
+    sink = analysis.MemoryResultSink()
+    record = {"game_uuid": "game-1", "white": "player1", "black": "player2", "end_time": 1718452800,
+              "game_url": "https://www.chess.com/game/live/1", "message_id": "message-1",
+              "stats": {colour: {'inaccuracies': 1, 'mistakes': 0, 'blunders': 0} for colour in ['white', 'black']}}
+    sink.emit([record])
+
+    def failing(TransactItems):
+        raise cancelled_transaction(['ThrottlingError'] * len(TransactItems))
+
+    # A failed write leaves the records in the sink
+    with monkeypatch.context() as patch:
+        patch.setattr(dynamodb_table.meta.client, 'transact_write_items', failing)
+        with pytest.raises(ClientError):
+            analysis.reduce_results(sink, dynamodb_table, processed_games_table)
+    assert len(sink.read()) == 1
+    assert 'game_stats' not in dynamodb_table.get_item(Key={'username': 'player1'})['Item']
+
+    assert analysis.reduce_results(sink, dynamodb_table, processed_games_table) == 1
+    # A worker that crashed after emitting emits the game again on redelivery
+    sink.emit([record, dict(record, game_uuid='game-2')])
+    assert analysis.reduce_results(sink, dynamodb_table, processed_games_table) == 1
+
+    game_stats = dynamodb_table.get_item(Key={'username': 'player1'})['Item']['game_stats']
+    assert game_stats['y2024']['total_games'] == 2
+    assert sink.read() == []
+
+def test_reducer_only_finishes_a_run_with_all_of_its_games(dynamodb_table, processed_games_table, monkeypatch):
+    for player in ['player1', 'player2']:
+        dynamodb_table.put_item(Item={'username': player})
+    sink = analysis.MemoryResultSink()
+    for game_uuid in ['game-a', 'game-b']:
+        sink.emit([{"game_uuid": game_uuid, "white": "player1", "black": "player2", "end_time": 1718452800,
+                    "game_url": f"https://www.chess.com/game/live/{game_uuid}", "message_id": "message-1",
+                    "stats": {colour: {'inaccuracies': 1, 'mistakes': 0, 'blunders': 0} for colour in ['white', 'black']}}])
+
+    def failing(TransactItems):
+        raise cancelled_transaction(['ThrottlingError'] * len(TransactItems))
+
+    with monkeypatch.context() as patch:
+        patch.setattr(dynamodb_table.meta.client, 'transact_write_items', failing)
+        with pytest.raises(ClientError):
+            analysis.reduce_results(sink, dynamodb_table, processed_games_table)
+
+    # A read that returns only some of the failed run's games leaves the run and its records alone
+    class PartialSink:
+        def read(self):
+            return sink.read()[:1]
+
+    assert analysis.reduce_results(PartialSink(), dynamodb_table, processed_games_table) == 0
+    assert len(sink.read()) == 2
+    assert 'game_stats' not in dynamodb_table.get_item(Key={'username': 'player1'})['Item']
+
+    assert analysis.reduce_results(sink, dynamodb_table, processed_games_table) == 2
+    assert dynamodb_table.get_item(Key={'username': 'player1'})['Item']['game_stats']['y2024']['total_games'] == 2
+    assert sink.read() == []
+
+def test_drain_queue_processes_messages_with_one_engine(dynamodb_table, processed_games_table, sqs, queue,
+                                                        monkeypatch):
+    for player in ['player1', 'player2']:
+        dynamodb_table.put_item(Item={'username': player})
+    for i in range(3):
+        games = [{"game_uuid": f"game-{i}", "white": "player1", "black": "player2", "moves": "e4 e5 Nf3",
+                  "end_time": 1718452800, "game_url": f"https://www.chess.com/game/live/{i}"}]
+        sqs.send_message(QueueUrl=queue, MessageBody=json.dumps(games))
+    engine = CountingEngine()
+    for name, value in [('sqs', sqs), ('QUEUE_URL', queue), ('RECEIVE_WAIT_SECONDS', 0),
+                        ('engine', engine), ('eval_cache', None),
+                        ('player_stats_table', dynamodb_table), ('processed_games_table', processed_games_table)]:
+        monkeypatch.setattr(analysis, name, value, raising=False)
+
+    assert analysis.drain_queue(max_messages=2) == 2
+    assert analysis.drain_queue(prefetch=1) == 1
+
+    game_stats = dynamodb_table.get_item(Key={'username': 'player1'})['Item']['game_stats']
+    assert game_stats['y2024']['total_games'] == 3
+    # The same engine analyzed every message
+    assert len(engine.fens) == 3 * 4
+    assert 'Messages' not in sqs.receive_message(QueueUrl=queue)
+
+def test_prefetched_messages_are_released_on_shutdown(sqs, queue, monkeypatch):
+    sqs.send_message(QueueUrl=queue, MessageBody='[]')
+    monkeypatch.setattr(analysis, 'sqs', sqs, raising=False)
+    monkeypatch.setattr(analysis, 'QUEUE_URL', queue)
+    monkeypatch.setattr(analysis, 'RECEIVE_WAIT_SECONDS', 0)
+
+    prefetcher = analysis.MessagePrefetcher()
+    with prefetcher.condition:
+        prefetcher.condition.wait_for(lambda: prefetcher.ready)
+    assert 'Messages' not in sqs.receive_message(QueueUrl=queue)
+    prefetcher.release()
+    prefetcher.thread.join()
+
+    assert len(sqs.receive_message(QueueUrl=queue)['Messages']) == 1
+
+def test_heartbeat_extends_leases_only_while_progressing(sqs, queue, monkeypatch):
+    sqs.send_message(QueueUrl=queue, MessageBody='[]')
+    monkeypatch.setattr(analysis, 'sqs', sqs, raising=False)
+    monkeypatch.setattr(analysis, 'QUEUE_URL', queue)
+    monkeypatch.setattr(analysis, 'message', sqs.receive_message(QueueUrl=queue)['Messages'])
+
+    heartbeat = analysis.Heartbeat(interval=0.05)
+    for _ in range(3):
+        analysis.record_progress()
+        time.sleep(0.1)
+    time.sleep(0.2)
+    heartbeat.stop()
+
+    stats = heartbeat.stats()
+    assert 1 <= stats['extensions'] <= 3
+    assert stats['stalls'] >= 1
+    assert stats['failures'] == 0
+
+def test_heartbeat_only_extends_the_current_message_until_shutdown(monkeypatch):
+    class RecordingSqs:
+        def __init__(self):
+            self.extended = []
+
+        def change_message_visibility(self, QueueUrl, ReceiptHandle, VisibilityTimeout):
+            self.extended.append(ReceiptHandle)
+
+    recording = RecordingSqs()
+    monkeypatch.setattr(analysis, 'sqs', recording, raising=False)
+    monkeypatch.setattr(analysis, 'shutdown_flag', False)
+    monkeypatch.setattr(analysis, 'message', [{'MessageId': f'message-{i}', 'ReceiptHandle': f'handle-{i}'}
+                                              for i in range(3)])
+    heartbeat = analysis.Heartbeat(interval=60)
+
+    heartbeat.beat()
+    # A message released by the signal handler stays visible to other workers
+    analysis.shutdown_flag = True
+    heartbeat.beat()
+    heartbeat.stop()
+
+    assert recording.extended == ['handle-0']
+    assert heartbeat.stats()['extensions'] == 1
+
+def test_prefetched_messages_stay_leased_and_lapsed_ones_are_dropped(monkeypatch):
+    class StubSqs:
+        def __init__(self):
+            self.extended = []
+            self.lost = set()
+            self.received = [[{'MessageId': f'message-{i}', 'ReceiptHandle': f'handle-{i}'} for i in (1, 2)]]
+
+        def receive_message(self, **kwargs):
+            return {'Messages': self.received.pop(0) if self.received else []}
+
+        def change_message_visibility(self, QueueUrl, ReceiptHandle, VisibilityTimeout):
+            if ReceiptHandle in self.lost:
+                raise ClientError({'Error': {'Code': 'InvalidParameterValue'}}, 'ChangeMessageVisibility')
+            self.extended.append(ReceiptHandle)
+
+    stub = StubSqs()
+    monkeypatch.setattr(analysis, 'sqs', stub, raising=False)
+    monkeypatch.setattr(analysis, 'shutdown_flag', False)
+    prefetcher = analysis.MessagePrefetcher(2)
+    monkeypatch.setattr(analysis, 'prefetcher', prefetcher)
+    with prefetcher.condition:
+        prefetcher.condition.wait_for(lambda: prefetcher.ready)
+    monkeypatch.setattr(analysis, 'message', [{'MessageId': 'message-0', 'ReceiptHandle': 'handle-0'}])
+
+    heartbeat = analysis.Heartbeat(interval=60)
+    heartbeat.beat()
+    heartbeat.stop()
+    assert stub.extended == ['handle-0', 'handle-1', 'handle-2']
+
+    # Another worker received message-1 after its lease lapsed
+    stub.lost.add('handle-1')
+    assert [queued['MessageId'] for queued in prefetcher.take()] == ['message-2']
+    prefetcher.release()
+    prefetcher.thread.join()
+
+def test_redelivered_message_resumes_from_checkpoint(dynamodb_table, processed_games_table, sqs, monkeypatch):
+    for player in ['player1', 'player2']:
+        dynamodb_table.put_item(Item={'username': player})
+    games = [{"game_uuid": "game-1", "white": "player1", "black": "player2", "moves": "e4 e5 Nf3 Nc6 Bb5",
+              "end_time": 1718452800, "game_url": "https://www.chess.com/game/live/1"}]
+    message = [{'MessageId': 'test-message-id', 'Body': json.dumps(games), 'ReceiptHandle': 'test-receipt-handle'}]
+    monkeypatch.setattr(analysis, 'CHECKPOINT_PLIES', 2)
+
+    class PreemptedEngine(CountingEngine):
+        def analyse(self, board, limit):
+            if len(self.fens) == 1:
+                analysis.shutdown_flag = True
+            return super().analyse(board, limit)
+
+    monkeypatch.setattr(analysis, 'shutdown_flag', False)
+    process_message(message, PreemptedEngine(), dynamodb_table, processed_games_table, sqs)
+    item = processed_games_table.get_item(Key={'message_id': 'test-message-id'})['Item']
+    assert len(item['checkpoint:game-1']) == 2
+    assert 'game_stats' not in dynamodb_table.get_item(Key={'username': 'player1'})['Item']
+
+    monkeypatch.setattr(analysis, 'shutdown_flag', False)
+    engine = CountingEngine()
+    process_message(message, engine, dynamodb_table, processed_games_table, sqs)
+
+    assert len(engine.fens) == 4
+    expected = analyze_moves(games[0]['moves'].split(), CountingEngine(), chess.Board())['white']
+    assert dynamodb_table.get_item(Key={'username': 'player1'})['Item']['game_stats']['y2024']['player_total'] == expected
+    item = processed_games_table.get_item(Key={'message_id': 'test-message-id'})['Item']
+    assert item['processed_game_ids'] == {'game-1'}
+    assert 'checkpoint:game-1' not in item
+
+def test_shutdown_mid_game_keeps_the_finished_games(dynamodb_table, processed_games_table, sqs, monkeypatch):
+    for player in ['player1', 'player2']:
+        dynamodb_table.put_item(Item={'username': player})
+    games = [{"game_uuid": game_uuid, "white": "player1", "black": "player2", "moves": moves,
+              "end_time": 1718452800, "game_url": f"https://www.chess.com/game/live/{game_uuid}"}
+             for game_uuid, moves in [("game-a", "d4"), ("game-b", "e4 e5 Nf3 Nc6 Bb5")]]
+    message = [{'MessageId': 'test-message-id', 'Body': json.dumps(games), 'ReceiptHandle': 'test-receipt-handle'}]
+    monkeypatch.setattr(analysis, 'CHECKPOINT_PLIES', 2)
+    monkeypatch.setattr(analysis, 'shutdown_flag', False)
+
+    class PreemptedEngine(CountingEngine):
+        def analyse(self, board, limit):
+            if board.move_stack and board.move_stack[0] == chess.Move.from_uci('e2e4'):
+                analysis.shutdown_flag = True
+            return super().analyse(board, limit)
+
+    process_message(message, PreemptedEngine(), dynamodb_table, processed_games_table, sqs)
+
+    item = processed_games_table.get_item(Key={'message_id': 'test-message-id'})['Item']
+    assert item['processed_game_ids'] == {'game-a'}
+    assert 'checkpoint:game-b' in item
+    game_stats = dynamodb_table.get_item(Key={'username': 'player1'})['Item']['game_stats']
+    assert game_stats['y2024']['total_games'] == 1
+
+def test_finished_game_is_not_checkpointed(dynamodb_table, processed_games_table, sqs, monkeypatch):
+    for player in ['player1', 'player2']:
+        dynamodb_table.put_item(Item={'username': player})
+    games = [{"game_uuid": "game-1", "white": "player1", "black": "player2", "moves": "e4 e5 Nf3",
+              "end_time": 1718452800, "game_url": "https://www.chess.com/game/live/1"}]
+    message = [{'MessageId': 'test-message-id', 'Body': json.dumps(games), 'ReceiptHandle': 'test-receipt-handle'}]
+    monkeypatch.setattr(analysis, 'CHECKPOINT_PLIES', 10)
+    table = CountingTable(processed_games_table)
+
+    process_message(message, CountingEngine(), dynamodb_table, table, sqs)
+
+    # The game fits in one chunk, so only its stats write touches the item
+    assert 'update_item' not in table.calls
+    item = processed_games_table.get_item(Key={'message_id': 'test-message-id'})['Item']
+    assert item['processed_game_ids'] == {'game-1'}
+    assert not [name for name in item if name.startswith('checkpoint:')]
+
+def test_roster_is_looked_up_per_message_unless_draining(dynamodb_table, processed_games_table, sqs, monkeypatch):
+    dynamodb_table.put_item(Item={'username': 'player1'})
+    lookups = []
+    dynamodb_table.meta.client.meta.events.register(
+        'before-parameter-build.dynamodb.BatchGetItem',
+        lambda params, **kwargs: lookups.extend(params['RequestItems'][dynamodb_table.name]['Keys']))
+    monkeypatch.setattr(analysis, 'tracked_roster', None)
+    table = CountingTable(dynamodb_table)
+
+    for n, drain_mode in enumerate([False, True, True]):
+        monkeypatch.setattr(analysis, 'DRAIN_MODE', drain_mode)
+        games = [{"game_uuid": f"game-{n}-{i}", "white": "player1", "black": opponent, "moves": "e4 e5",
+                  "end_time": 1718452800, "game_url": f"https://www.chess.com/game/live/{i}"}
+                 for i, opponent in enumerate(['stranger1', 'stranger2'])]
+        message = [{'MessageId': f'message-{n}', 'Body': json.dumps(games), 'ReceiptHandle': 'test-receipt-handle'}]
+        process_message(message, CountingEngine(), table, processed_games_table, sqs)
+
+    # One lookup of the message's distinct players, then one cached scan for both drained messages
+    assert sorted(key['username']['S'] for key in lookups) == ['player1', 'stranger1', 'stranger2']
+    assert table.calls.count('scan') == 1
+
+def test_games_without_tracked_players_skip_analysis(dynamodb_table, processed_games_table, sqs):
+    period = {'total_games': 0, 'player_total': {}, 'worst_game': {}}
+    dynamodb_table.put_item(Item={'username': 'player1', 'game_stats': {'y2024': dict(period, m06=period)}})
+    games = [
+        {"game_uuid": "game-1", "white": "player1", "black": "stranger1", "moves": "e4 e5",
+         "end_time": 1718452800, "game_url": "https://www.chess.com/game/live/1"},
+        {"game_uuid": "game-2", "white": "stranger1", "black": "stranger2", "moves": "d4 d5",
+         "end_time": 1718452800, "game_url": "https://www.chess.com/game/live/2"},
+    ]
+    message = [{'MessageId': 'test-message-id', 'Body': json.dumps(games), 'ReceiptHandle': 'test-receipt-handle'}]
+    engine = CountingEngine()
+
+    transactions = count_transactions(dynamodb_table)
+
+    process_message(message, engine, dynamodb_table, processed_games_table, sqs)
+
+    assert len(engine.fens) == 3
+    # The untracked opponent is left out, so the transaction is not cancelled and retried
+    assert transactions == [1]
+    processed = processed_games_table.get_item(Key={'message_id': 'test-message-id'})['Item']
+    assert processed['processed_game_ids'] == {'game-1'}
+    assert 'Item' not in dynamodb_table.get_item(Key={'username': 'stranger1'})
+
+def test_metrics_endpoint_reports_progress(dynamodb_table, processed_games_table, sqs):
+    for player in ['player1', 'player2']:
+        dynamodb_table.put_item(Item={'username': player})
+    games = [{"game_uuid": "game-1", "white": "player1", "black": "player2", "moves": "e4 e5 Nf3",
+              "end_time": 1718452800, "game_url": "https://www.chess.com/game/live/1"}]
+    message = [{'MessageId': 'test-message-id', 'Body': json.dumps(games), 'ReceiptHandle': 'test-receipt-handle'}]
+    analysis.record_write_latency(dynamodb_table.meta.client)
+    before = {name: analysis.metrics.value(name) for name in
+              ['analysis_engine_searches_total', 'analysis_plies_total', 'analysis_dynamodb_write_seconds']}
+
+    process_message(message, CountingEngine(), dynamodb_table, processed_games_table, sqs)
+
+    server = analysis.start_metrics_server(0)
+    try:
+        url = f"http://127.0.0.1:{server.server_address[1]}/metrics"
+        body = urllib.request.urlopen(url).read().decode()
+    finally:
+        server.shutdown()
+    samples = dict(line.rsplit(' ', 1) for line in body.splitlines() if not line.startswith('#'))
+    assert float(samples['analysis_engine_searches_total']) - before['analysis_engine_searches_total'] == 4
+    assert float(samples['analysis_plies_total']) - before['analysis_plies_total'] == 3
+    assert float(samples['analysis_dynamodb_write_seconds_count']) > before['analysis_dynamodb_write_seconds']
+    assert samples['analysis_message_games_done'] == '1'
+    assert '# TYPE analysis_engine_search_seconds histogram' in body
+
+def test_event_log_levels_samples_and_buffers(capsys):
+    event_log = analysis.EventLog(level='info', sample_rate=0, buffer_lines=10, flush_seconds=3600)
+
+    event_log.emit('debug', 'search', nodes=100)
+    event_log.emit('info', 'search', sampled=True, nodes=100)
+    event_log.emit('info', 'game', game_uuid='game-1')
+    assert capsys.readouterr().out == ''
+
+    event_log.emit('error', 'log', msg='Error writing stats batch')
+    events = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert [(event['level'], event['event']) for event in events] == [('info', 'game'), ('error', 'log')]
+    assert events[0]['game_uuid'] == 'game-1'
+
+def test_event_log_can_be_reentered_from_a_signal_handler(capsys):
+    event_log = analysis.EventLog(level='info', buffer_lines=10, flush_seconds=3600)
+
+    # A handler interrupting an emit or flush runs on the thread holding the lock
+    def interrupted():
+        with event_log.lock:
+            event_log.emit('warning', 'log', msg='Error releasing message')
+    thread = threading.Thread(target=interrupted, daemon=True)
+    thread.start()
+    thread.join(timeout=5)
+
+    assert not thread.is_alive()
+    assert [json.loads(line)['msg'] for line in capsys.readouterr().out.splitlines()] == ['Error releasing message']
+
+def test_signal_handler_releases_quietly(monkeypatch):
+    class StubSqs:
+        def change_message_visibility(self, QueueUrl, ReceiptHandle, VisibilityTimeout):
+            if ReceiptHandle == 'handle-1':
+                raise ClientError({'Error': {'Code': 'ReceiptHandleIsInvalid'}}, 'ChangeMessageVisibility')
+
+    class SilentLog(analysis.EventLog):
+        def emit(self, level, event, sampled=False, **fields):
+            raise AssertionError(f"logged {fields} from the signal handler")
+
+    monkeypatch.setattr(analysis, 'sqs', StubSqs(), raising=False)
+    monkeypatch.setattr(analysis, 'event_log', SilentLog())
+    for name, value in [('shutdown_flag', False), ('shutdown_signal', None), ('shutdown_releases', (0, [])),
+                        ('prefetcher', None)]:
+        monkeypatch.setattr(analysis, name, value)
+    monkeypatch.setattr(analysis, 'message', [{'MessageId': f'message-{i}', 'ReceiptHandle': f'handle-{i}'}
+                                              for i in range(2)])
+
+    analysis.signal_handler(15, None)
+
+    assert analysis.shutdown_flag and analysis.shutdown_signal == 15
+    assert analysis.shutdown_releases == (2, ['message-1'])
+
+def test_search_and_ply_events_are_sampled_at_info(monkeypatch):
+    event_log = analysis.EventLog(level='info', sample_rate=1, buffer_lines=1000, flush_seconds=3600)
+    monkeypatch.setattr(analysis, 'event_log', event_log)
+
+    analyze_moves("e4 e5 Nf3".split(), CountingEngine(), chess.Board())
+
+    events = [json.loads(line) for line in event_log.buffer]
+    assert [event['event'] for event in events].count('search') == 4
+    assert [event['ply'] for event in events if event['event'] == 'ply'] == [1, 2, 3]
+    assert {'seconds', 'depth', 'nodes', 'nps'} <= set(next(event for event in events if event['event'] == 'search'))
+
+def test_run_profiled_writes_profile_and_summary(tmp_path):
+    moves = "e4 e5 Nf3 Nc6 Bb5".split()
+
+    stats = analysis.run_profiled(str(tmp_path / 'profiles'), 'test-message-id', analyze_moves,
+                                  moves, CountingEngine(), chess.Board())
+
+    assert stats == analyze_moves(moves, CountingEngine(), chess.Board())
+    assert (tmp_path / 'profiles' / 'test-message-id.prof').stat().st_size > 0
+    assert 'replay_positions' in (tmp_path / 'profiles' / 'test-message-id.txt').read_text()
+
+def test_run_profiled_samples_every_thread(tmp_path):
+    # python-chess runs the UCI protocol on a thread of its own, like this one
+    def protocol_loop():
+        deadline = time.monotonic() + 0.2
+        while time.monotonic() < deadline:
+            sum(range(1000))
+
+    def analyse():
+        thread = threading.Thread(target=protocol_loop, name='engine-loop')
+        thread.start()
+        thread.join()
+
+    analysis.run_profiled(str(tmp_path), 'test-message-id', analyse)
+
+    folded = (tmp_path / 'test-message-id.folded').read_text().splitlines()
+    assert any(line.startswith('engine-loop;') and 'protocol_loop' in line for line in folded)
+    assert 'Thread engine-loop:' in (tmp_path / 'test-message-id.txt').read_text()
+
+def test_benchmark_reports_and_compares_to_baseline():
+    corpus = benchmark.load_corpus()
+
+    report = benchmark.run_benchmark(corpus, CountingEngine(), mode='message')
+
+    assert report['games'] == len(corpus['games'])
+    assert report['plies'] == sum(len(game['moves'].split()) for game in corpus['games'])
+    # Shared openings are searched once per message, and checkmates not at all
+    assert report['searches_per_game'] < report['plies'] / report['games']
+    assert report['p50_game_seconds'] <= report['p95_game_seconds']
+    assert benchmark.compare_to_baseline(report, dict(report)) == []
+    slower = dict(report, plies_per_second=report['plies_per_second'] * 2)
+    assert [regression.split(':')[0] for regression in benchmark.compare_to_baseline(report, slower)] == \
+        ['plies_per_second']
+
+def test_benchmark_matches_the_committed_fake_engine_baseline(monkeypatch):
+    monkeypatch.setattr(analysis, 'eval_cache', None)
+    with open(benchmark.FAKE_ENGINE_BASELINE) as f:
+        baseline = json.load(f)
+    engine = chess.engine.SimpleEngine.popen_uci(FAKE_ENGINE_PATH)
+    try:
+        report = benchmark.run_benchmark(benchmark.load_corpus(), engine, mode='message')
+    finally:
+        engine.quit()
+
+    assert benchmark.compare_to_baseline(report, baseline) == []
+    assert set(baseline) == set(benchmark.PORTABLE_METRICS)
+
+def test_fake_engine_is_deterministic(monkeypatch):
+    monkeypatch.setenv('FAKE_ENGINE_LATENCY_MS', '20')
+    board = chess.Board()
+    for move in ["e4", "e5", "Qh5", "Nc6", "Bc4", "Nf6"]:
+        board.push_san(move)
+
+    analysis.init_engine(path=FAKE_ENGINE_PATH, pool_size=1)
+    try:
+        started = time.perf_counter()
+        info = analysis.engine.analyse(board, SEARCH_LIMIT)
+        assert time.perf_counter() - started >= 0.02
+        assert info['score'].white() == chess.engine.Mate(1)
+        assert info['pv'][0] == board.parse_san("Qxf7#")
+        board.pop()
+        scores = [analysis.engine.analyse(board, SEARCH_LIMIT)['score'] for _ in range(2)]
+    finally:
+        analysis.engine.quit()
+
+    assert scores[0] == scores[1]
+    assert abs(scores[0].white().score()) <= 10
+
+def test_eval_cache_lru_and_disk_tier(tmp_path):
+    path = str(tmp_path / 'evals.sqlite3')
+    boards = [chess.Board()]
+    for move in ["e4", "e5"]:
+        boards.append(boards[-1].copy())
+        boards[-1].push_san(move)
+
+    cache = EvalCache(size=2, path=path)
+    for i, board in enumerate(boards):
+        cache.put(board, SEARCH_LIMIT, i * 10)
+    assert len(cache.entries) == 2
+    assert cache.get(boards[0], SEARCH_LIMIT) == 0
+    assert cache.get(boards[0], chess.engine.Limit(depth=10)) is None
+    cache.close()
+
+    reopened = EvalCache(size=2, path=path)
+    assert [reopened.get(board, SEARCH_LIMIT) for board in boards] == [0, 10, 20]
+    assert reopened.stats()['disk_hits'] == 3
+    reopened.close()
+
+def test_eval_cache_is_keyed_by_engine_and_capped(tmp_path):
+    path = str(tmp_path / 'evals.sqlite3')
+    boards = [chess.Board()]
+    for move in ["e4", "e5", "Nf3"]:
+        boards.append(boards[-1].copy())
+        boards[-1].push_san(move)
+
+    cache = EvalCache(size=10, path=path, disk_rows=2)
+    cache.trim_every = 1
+    cache.set_engine("Stockfish 16.1|stockfish-avx2|")
+    for i, board in enumerate(boards):
+        cache.put(board, SEARCH_LIMIT, i * 10)
+    cache.close()
+
+    # Only the scores written last stay on disk
+    reopened = EvalCache(size=10, path=path)
+    reopened.set_engine("Stockfish 16.1|stockfish-avx2|")
+    assert [reopened.get(board, SEARCH_LIMIT) for board in boards] == [None, None, 20, 30]
+    # An upgraded engine does not reuse them
+    reopened.set_engine("Stockfish 17|stockfish-avx2|")
+    assert reopened.get(boards[-1], SEARCH_LIMIT) is None
+    reopened.close()
+
+def test_init_engine_keys_the_cache_by_engine(monkeypatch):
+    monkeypatch.setattr(analysis, 'engine', None)
+    cache = EvalCache(size=10)
+    try:
+        analysis.init_engine(path=FAKE_ENGINE_PATH, pool_size=1, cache=cache)
+        identity = analysis.engine_identity(analysis.engine, FAKE_ENGINE_PATH)
+    finally:
+        analysis.engine.quit()
+
+    assert identity.endswith('|fake_uci_engine.py|')
+    assert cache.engine == hashlib.sha1(identity.encode()).hexdigest()[:16]
+
+def test_engine_pool_matches_serial(chess_engine):
+    games = [["e4", "e5", "Qh5", "Nc6", "Bc4", "Nf6", "Qxf7#"],
+             ["d4", "d5", "c4", "e6", "Nc3", "Nf6"]]
+
+    serial = [analyze_moves(moves, chess_engine, chess.Board()) for moves in games]
+
+    pool = EnginePool(engine_path(), 2)
+    try:
+        pooled = [analyze_moves(moves, pool, chess.Board()) for moves in games]
+    finally:
+        pool.quit()
+
+    assert pooled == serial
+
+def test_process_message_with_engine_pool(dynamodb_table, processed_games_table, sqs):
+    for player in ['player1', 'player2']:
+        dynamodb_table.put_item(Item={'username': player})
+    games = [{"game_uuid": f"game-{i}", "white": "player1", "black": "player2", "moves": moves,
+              "end_time": 1718452800, "game_url": f"https://www.chess.com/game/live/{i}"}
+             for i, moves in enumerate(["e4 e5 Qh5 Nc6 Bc4 Nf6 Qxf7#", "d4 d5 c4 e6 Nc3 Nf6"])]
+    message = [{'MessageId': 'test-message-id', 'Body': json.dumps(games), 'ReceiptHandle': 'test-receipt-handle'}]
+    searches = analysis.metrics.value('analysis_engine_searches_total')
+
+    pool = EnginePool(engine_path(), 2, parallelism='position')
+    try:
+        process_message(message, pool, dynamodb_table, processed_games_table, sqs)
+    finally:
+        pool.quit()
+
+    # Every position but the final checkmate and the shared starting position is searched once on the pool
+    assert analysis.metrics.value('analysis_engine_searches_total') - searches == 7 + 6
+    processed = processed_games_table.get_item(Key={'message_id': 'test-message-id'})['Item']
+    assert processed['processed_game_ids'] == {'game-0', 'game-1'}
+    game_stats = dynamodb_table.get_item(Key={'username': 'player2'})['Item']['game_stats']
+    assert game_stats['y2024']['total_games'] == 2
+    assert game_stats['y2024']['player_total']['blunders'] >= 1
+
+def test_shard_positions():
+    positions = list(range(8))
+
+    shards = shard_positions(positions, 3)
+
+    assert [len(shard) for shard in shards] == [3, 3, 2]
+    assert [p for shard in shards for p in shard] == positions
+    assert shard_positions(positions[:2], 4) == [[0], [1]]
+    assert shard_positions([], 4) == []
     
 # def test_process_message(dynamodb_table, chess_engine, processed_games_table, sqs):
 #     players = ['player1', 'player2']
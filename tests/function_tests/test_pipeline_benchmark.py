@@ -0,0 +1,55 @@
+import pytest
+import chess.engine
+
+from tests import pipeline_benchmark
+
+@pytest.fixture(scope="module")
+def fake_engine():
+    engine = chess.engine.SimpleEngine.popen_uci(pipeline_benchmark.FAKE_ENGINE_PATH)
+    yield engine
+
+    engine.quit()
+
+def test_pipeline_benchmark_accounts_requests_per_stage(fake_engine):
+    report = pipeline_benchmark.run_pipeline(4, games_per_player=2, engine=fake_engine, api_reads=2)
+
+    stages = {stage['stage']: stage for stage in report['stages']}
+    assert list(stages) == pipeline_benchmark.STAGES
+    assert [name for name, stage in stages.items() if 'error' in stage] == []
+    assert report['games'] == 8
+
+    # Two writes per tracked player: the 4 synthetic players and the 21 personalities
+    imported = stages['import_player_games']['services']
+    assert imported['dynamodb']['operations']['UpdateItem'] == 2 * 25
+    assert imported['ssm']['calls'] == 1
+    assert imported['chess.com']['operations']['games'] == 25
+
+    # Every message enqueued is received and deleted by the worker
+    sent = stages['enqueue_dynamodb_items']['services']['sqs']['operations']['SendMessage']
+    worker = stages['analysis_worker']['services']
+    assert worker['sqs']['operations']['DeleteMessage'] == sent
+    assert worker['dynamodb']['operations']['TransactWriteItems'] >= sent
+    assert worker['dynamodb']['request_bytes'] > 0 and worker['dynamodb']['response_bytes'] > 0
+
+    assert stages['api_reads']['services']['dynamodb']['operations']['GetItem'] == 2 + 2
+    assert report['totals']['dynamodb']['calls'] == sum(stage['services']['dynamodb']['calls']
+                                                        for stage in report['stages'])
+
+def test_pipeline_benchmark_scales_sampled_worker_counts(fake_engine):
+    report = pipeline_benchmark.run_pipeline(4, games_per_player=2, engine=fake_engine, api_reads=2,
+                                             stages=['import_player_games', 'enqueue_dynamodb_items',
+                                                     'analysis_worker'], worker_messages=1)
+
+    stages = {stage['stage']: stage for stage in report['stages']}
+    worker = stages['analysis_worker']
+    sent = stages['enqueue_dynamodb_items']['services']['sqs']['operations']['SendMessage']
+    assert worker['sampled_messages'] == 1 and worker['queued_messages'] == sent
+    assert worker['services']['sqs']['operations']['DeleteMessage'] == 1
+    estimated = worker['estimated_services']
+    assert estimated['sqs']['operations']['DeleteMessage'] == sent
+    # The roster is scanned once per worker, however many messages it drains
+    assert estimated['dynamodb']['operations']['Scan'] == 1
+    assert report['totals']['dynamodb']['calls'] == sum(stage.get('estimated_services', stage['services'])['dynamodb']['calls']
+                                                        for stage in report['stages'])
+    assert report['totals']['dynamodb']['calls'] > sum(stage['services']['dynamodb']['calls']
+                                                       for stage in report['stages'])
@@ -0,0 +1,336 @@
+"""End-to-end benchmark of the daily pipeline against moto.
+
+Stands up the tables, queue and SSM parameter under moto, serves N
+synthetic leaderboard players and their games from a fake chess.com API,
+and runs every stage in-process:
+
+    import_player_games -> enqueue_dynamodb_items -> analysis worker
+    -> update_leaderboard_history -> last_updated -> API reads
+
+The worker drains the queue with the deterministic fake engine by default.
+For each stage the report has the wall time and, per service, the number
+of calls, the request and response bytes, and the calls per operation:
+
+    python tests/pipeline_benchmark.py --players 100 1000 10000
+    python tests/pipeline_benchmark.py --players 1000 --games-per-player 3 --engine /usr/games/stockfish
+
+AWS requests are counted through botocore event hooks, so the numbers are
+the requests the functions would make against DynamoDB and SQS; the
+latencies are moto's, not AWS's. moto copies a whole table for every item
+of a transaction, so the worker's wall time grows with the table far
+faster than on AWS. The worker therefore only drains --worker-messages
+messages (20 by default, 0 for all of them). When that leaves some of
+the queue, its stage also reports estimated_services and
+estimated_seconds, scaled from the sample to every queued message. The
+totals use those estimates. The stages after it see the stats of the
+sampled games only.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+from urllib.parse import urlencode, urlparse
+
+import boto3
+import botocore.handlers
+import chess.engine
+from moto import mock_aws
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(ROOT)
+sys.path.append(os.path.join(ROOT, 'container', 'chess-analysis', 'eks'))
+
+import analysis
+from functions.api.get_last_updated import get_last_updated
+from functions.api.get_leaderboard_history import get_leaderboard_history
+from functions.api.get_player_stats import get_player_stats
+from functions.api.get_players import get_players
+from functions.enqueue_dynamodb_items import enqueue_dynamodb_items
+from functions.import_player_games import import_player_games
+from functions.last_updated import last_updated
+from functions.update_leaderboard_history import update_leaderboard_history
+from tests.analysis_tests import benchmark
+from tests.analysis_tests.dynamodb_transactions import cancel_like_dynamodb
+
+REGION = 'us-east-1'
+FAKE_ENGINE_PATH = os.path.join(ROOT, 'tests', 'analysis_tests', 'fake_uci_engine.py')
+TABLES = {
+    'GAME_IMPORTS_TABLE': ('bench-GameImportsTable', 'game_uuid'),
+    'TRACKED_PLAYERS_TABLE': ('bench-TrackedPlayersTable', 'username'),
+    'PLAYER_STATS_TABLE': ('bench-PlayerStatsTable', 'username'),
+    'PROCESSED_GAMES_TABLE': ('bench-ProcessedGamesTable', 'message_id'),
+    'LEADERBOARD_HISTORY_TABLE': ('bench-LeaderboardHistory', 'date'),
+    'METADATA_TABLE': ('bench-MetadataTable', 'metadata_id'),
+}
+PARAMETER_NAME = 'bench-user-agent'
+# A drain mode worker scans the roster once and reuses it for every message
+WORKER_FIXED_OPERATIONS = {'Scan'}
+STAGES = ['import_player_games', 'enqueue_dynamodb_items', 'analysis_worker', 'update_leaderboard_history',
+          'last_updated', 'api_reads']
+
+class RequestAccounting:
+    """Tallies calls and bytes per pipeline stage and service.
+
+    The hooks are added to botocore's builtin handlers, like moto's own, so
+    the sessions the functions create for themselves are counted too.
+    """
+
+    def __init__(self):
+        self.stage = None
+        self.stages = {}
+
+    def service(self, name):
+        services = self.stages.setdefault(self.stage, {})
+        return services.setdefault(name, {'calls': 0, 'request_bytes': 0, 'response_bytes': 0, 'operations': {}})
+
+    def record(self, service, operation, request_bytes=0, response_bytes=0):
+        totals = self.service(service)
+        totals['calls'] += 1
+        totals['request_bytes'] += request_bytes
+        totals['response_bytes'] += response_bytes
+        totals['operations'][operation] = totals['operations'].get(operation, 0) + 1
+
+    def request_created(self, request, event_name, **kwargs):
+        body = request.body or b''
+        if isinstance(body, dict):
+            body = urlencode(body)
+        self.service(event_name.split('.')[1])['request_bytes'] += len(body)
+
+    def after_call(self, http_response, model, event_name, **kwargs):
+        self.record(event_name.split('.')[1], model.name, response_bytes=len(http_response.content or b''))
+
+    @contextlib.contextmanager
+    def installed(self):
+        hooks = [('request-created', self.request_created), ('after-call', self.after_call)]
+        botocore.handlers.BUILTIN_HANDLERS.extend(hooks)
+        try:
+            yield self
+        finally:
+            for hook in hooks:
+                botocore.handlers.BUILTIN_HANDLERS.remove(hook)
+
+class FakeResponse(io.BytesIO):
+    status = 200
+
+class FakeChessCom:
+    """Serves the chess.com endpoints import_player_games reads from the
+    synthetic players and games, and counts the requests."""
+
+    def __init__(self, players, games, accounting):
+        self.players = players
+        self.archives = {}
+        for game in games:
+            for colour in ('white', 'black'):
+                self.archives.setdefault(game[colour]['username'], []).append(game)
+        self.accounting = accounting
+
+    def urlopen(self, req):
+        parts = urlparse(req.full_url).path.strip('/').split('/')
+        if parts == ['pub', 'leaderboards']:
+            operation, data = 'leaderboards', {'live_blitz': self.players}
+        elif parts[-1] == 'stats':
+            operation, data = 'stats', {'chess_blitz': {'last': {'rating': 2000}}}
+        elif len(parts) == 3:
+            operation, data = 'player', {'username': parts[2], 'name': parts[2],
+                                         'country': 'https://api.chess.com/pub/country/US'}
+        else:
+            operation, data = 'games', {'games': self.archives.get(parts[2].lower(), [])}
+        body = json.dumps(data).encode('utf-8')
+        self.accounting.record('chess.com', operation, response_bytes=len(body))
+        return FakeResponse(body)
+
+def yesterday_noon():
+    # Inside the window import_player_games fetches games for
+    noon = (datetime.now(timezone.utc) - timedelta(days=1)).replace(hour=12, minute=0, second=0)
+    return int(time.mktime(noon.timetuple()))
+
+def synthetic_players(count):
+    return [{'username': f"bench{i:05d}", 'name': f"Bench Player {i}", 'rank': i + 1, 'score': 3000 - i % 1000,
+             'country': 'https://api.chess.com/pub/country/US'} for i in range(count)]
+
+def synthetic_games(players, count, corpus_games):
+    """Returns chess.com archive games between neighbouring players, replaying
+    the corpus moves as PGN."""
+    end_time = yesterday_noon()
+    games = []
+    for i in range(count):
+        moves = corpus_games[i % len(corpus_games)]['moves'].split()
+        pgn = " ".join(f"{n // 2 + 1}. {move}" if n % 2 == 0 else move for n, move in enumerate(moves))
+        games.append({
+            'uuid': f"bench-game-{i:07d}",
+            'url': f"https://www.chess.com/game/live/{i}",
+            'white': {'username': players[i % len(players)]['username']},
+            'black': {'username': players[(i + 1) % len(players)]['username']},
+            'end_time': end_time,
+            'time_class': 'blitz',
+            'rules': 'chess',
+            'pgn': f'[Event "Live Chess"]\n\n{pgn} 1-0',
+        })
+    return games
+
+def create_resources():
+    dynamodb = boto3.resource('dynamodb', region_name=REGION)
+    for name, key in TABLES.values():
+        dynamodb.create_table(
+            TableName=name,
+            KeySchema=[{'AttributeName': key, 'KeyType': 'HASH'}],
+            AttributeDefinitions=[{'AttributeName': key, 'AttributeType': 'S'}],
+            BillingMode='PAY_PER_REQUEST'
+        )
+    boto3.client('ssm', region_name=REGION).put_parameter(Name=PARAMETER_NAME, Value='bench@example.com',
+                                                         Type='String')
+    return boto3.client('sqs', region_name=REGION).create_queue(QueueName='bench-analysis')['QueueUrl']
+
+@contextlib.contextmanager
+def patched(module, **values):
+    saved = {name: getattr(module, name, None) for name in values}
+    for name, value in values.items():
+        setattr(module, name, value)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            setattr(module, name, value)
+
+def run_worker(engine, queue_url, max_messages=0):
+    """Drains the queue the way a DRAIN_MODE worker pod does, stopping after
+    max_messages when set, and returns the messages processed."""
+    with patched(analysis, AWS_REGION=REGION, QUEUE_URL=queue_url, RECEIVE_WAIT_SECONDS=0,
+                 PLAYER_STATS_TABLE=TABLES['PLAYER_STATS_TABLE'][0],
+                 PROCESSED_GAMES_TABLE=TABLES['PROCESSED_GAMES_TABLE'][0],
+                 engine=engine, eval_cache=analysis.EvalCache(), result_sink=None, message=None,
+                 tracked_roster=None, DRAIN_MODE=True):
+        analysis.init_resources()
+        cancel_like_dynamodb(analysis.player_stats_table.meta.client)
+        return analysis.drain_queue(max_messages=max_messages, max_runtime=0, prefetch=0)
+
+def scaled(services, factor, fixed=WORKER_FIXED_OPERATIONS):
+    """Scales a stage's request counts by the factor, leaving the operations
+    made once per run as they are. Bytes are scaled with the calls."""
+    estimated = {}
+    for service, counts in services.items():
+        operations = {operation: calls if operation in fixed else round(calls * factor)
+                      for operation, calls in counts['operations'].items()}
+        calls = sum(operations.values())
+        ratio = calls / counts['calls'] if counts['calls'] else 0
+        estimated[service] = {'calls': calls, 'request_bytes': round(counts['request_bytes'] * ratio),
+                              'response_bytes': round(counts['response_bytes'] * ratio), 'operations': operations}
+    return estimated
+
+def read_api(players, api_reads):
+    """Makes the reads a visitor's page load makes."""
+    usernames = [player['username'] for player in players]
+    now = datetime.now()
+    get_players.lambda_handler({'queryStringParameters': {'list': 'true'}}, None)
+    get_players.lambda_handler({'queryStringParameters': {'usernames': ",".join(usernames[:100])}}, None)
+    for username in usernames[:api_reads]:
+        get_player_stats.lambda_handler({'pathParameters': {'username': username}}, None)
+    get_leaderboard_history.lambda_handler({'queryStringParameters': {'year': now.strftime('%Y'),
+                                                                      'month': now.strftime('%m')}}, None)
+    get_last_updated.lambda_handler({}, None)
+
+def run_pipeline(player_count, games_per_player=1, engine=None, api_reads=10, corpus=None, stages=STAGES,
+                 worker_messages=20):
+    """Runs the stages in pipeline order against fresh moto resources and
+    returns the report. The worker processes at most worker_messages
+    messages, or all of them when it is 0."""
+    corpus = corpus or benchmark.load_corpus()
+    players = synthetic_players(player_count)
+    games = synthetic_games(players, int(player_count * games_per_player), corpus['games'])
+    accounting = RequestAccounting()
+    chess_com = FakeChessCom(players, games, accounting)
+    environment = {name: table for name, (table, _) in TABLES.items()}
+    environment.update({'AWS_REGION': REGION, 'AWS_DEFAULT_REGION': REGION, 'PARAMETER_NAME': PARAMETER_NAME,
+                        'AWS_ACCESS_KEY_ID': 'testing', 'AWS_SECRET_ACCESS_KEY': 'testing'})
+    session = boto3.DEFAULT_SESSION
+    reports = []
+
+    with mock.patch.dict(os.environ, environment), mock_aws(), accounting.installed(), \
+            mock.patch.object(import_player_games.request, 'urlopen', chess_com.urlopen), \
+            patched(update_leaderboard_history, PLAYER_STATS_TABLE=environment['PLAYER_STATS_TABLE'],
+                    LEADERBOARD_HISTORY_TABLE=environment['LEADERBOARD_HISTORY_TABLE']):
+        # A fresh default session picks up the hooks
+        boto3.setup_default_session(region_name=REGION)
+        try:
+            queue_url = create_resources()
+            os.environ['SQS_QUEUE_URL'] = queue_url
+            runners = {
+                'import_player_games': lambda: import_player_games.lambda_handler({}, None),
+                'enqueue_dynamodb_items': lambda: enqueue_dynamodb_items.lambda_handler({}, None),
+                'analysis_worker': lambda: run_worker(engine, queue_url, worker_messages),
+                'update_leaderboard_history': lambda: update_leaderboard_history.lambda_handler({}, None),
+                'last_updated': lambda: last_updated.lambda_handler({}, None),
+                'api_reads': lambda: read_api(players, api_reads),
+            }
+            for name in STAGES:
+                if name not in stages:
+                    continue
+                accounting.stage = name
+                report = {'stage': name}
+                started = time.perf_counter()
+                try:
+                    result = runners[name]()
+                except Exception as e:
+                    result = None
+                    report['error'] = f"{type(e).__name__}: {e}"
+                report['seconds'] = round(time.perf_counter() - started, 3)
+                report['services'] = accounting.stages.get(name, {})
+                if name == 'analysis_worker' and result:
+                    queued = accounting.stages.get('enqueue_dynamodb_items', {}).get('sqs', {}) \
+                        .get('operations', {}).get('SendMessage', 0)
+                    if queued > result:
+                        report['sampled_messages'] = result
+                        report['queued_messages'] = queued
+                        report['estimated_services'] = scaled(report['services'], queued / result)
+                        report['estimated_seconds'] = round(report['seconds'] * queued / result, 3)
+                reports.append(report)
+        finally:
+            boto3.DEFAULT_SESSION = session
+
+    totals = {}
+    for stage in reports:
+        for service, counts in stage.get('estimated_services', stage['services']).items():
+            total = totals.setdefault(service, {'calls': 0, 'request_bytes': 0, 'response_bytes': 0})
+            for key in total:
+                total[key] += counts[key]
+    return {
+        'players': player_count,
+        'games': len(games),
+        'seconds': round(sum(stage['seconds'] for stage in reports), 3),
+        'stages': reports,
+        'totals': totals,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--players', type=int, nargs='+', default=[100])
+    parser.add_argument('--games-per-player', type=float, default=1)
+    parser.add_argument('--engine', default=FAKE_ENGINE_PATH)
+    parser.add_argument('--api-reads', type=int, default=10, help='single player stats reads in the API stage')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES)
+    parser.add_argument('--worker-messages', type=int, default=20,
+                        help='messages the worker processes before its counts are scaled to the queue, 0 for all')
+    parser.add_argument('--verbose', action='store_true', help="show the functions' own output")
+    args = parser.parse_args()
+
+    analysis.event_log.level = analysis.LOG_LEVELS['warning']
+    engine = chess.engine.SimpleEngine.popen_uci(args.engine) if 'analysis_worker' in args.stages else None
+    reports = []
+    try:
+        for player_count in args.players:
+            output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+            with output:
+                reports.append(run_pipeline(player_count, args.games_per_player, engine, args.api_reads,
+                                            stages=args.stages, worker_messages=args.worker_messages))
+    finally:
+        if engine is not None:
+            engine.quit()
+    print(json.dumps(reports, indent=2))
+
+if __name__ == '__main__':
+    main()